@@ -8,8 +8,131 @@ description: A filter pipeline that preprocess form data before requesting chat
 requirements:
 """
 
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel
+import fnmatch
+import logging
+import random
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TAGS = ["litellm-openwebui.changchiyou.com"]
+# Users whose trace_user_id is kept formatted
+TRACE_USER_CACHE_SIZE = 4096
+# Rough prompt cost of an attached image
+IMAGE_TOKENS = 765
+# Messages whose token estimate is kept
+TOKEN_CACHE_SIZE = 65536
+
+
+def message_tokens(message: dict) -> int:
+    # About 4 UTF-8 bytes per token: 4 ASCII characters, a little over one CJK character
+    content = message.get("content")
+    tokens = 4
+    if isinstance(content, str):
+        tokens += len(content.encode("utf-8")) // 4
+    elif isinstance(content, list):
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            if part.get("type") == "text":
+                tokens += len(part.get("text", "").encode("utf-8")) // 4
+            elif part.get("type") in ("image_url", "image"):
+                tokens += IMAGE_TOKENS
+            else:
+                # tool_use / tool_result blocks
+                tokens += len(str(part).encode("utf-8")) // 4
+    for tool_call in message.get("tool_calls") or ():
+        tokens += len(str(tool_call).encode("utf-8")) // 4
+    return tokens
+
+
+def _part_key(part) -> int:
+    # Images are priced flat, so their (base64) payload is never read
+    if not isinstance(part, dict):
+        return 0
+    kind = part.get("type")
+    if kind == "text":
+        return hash(part.get("text", ""))
+    if kind in ("image_url", "image"):
+        return IMAGE_TOKENS
+    return hash(str(part))
+
+
+def message_key(message: dict):
+    # Hash of what message_tokens() reads; str hashes are computed in C and cached on the string
+    content = message.get("content")
+    if isinstance(content, list):
+        content = tuple(_part_key(part) for part in content)
+    tool_calls = message.get("tool_calls")
+    return (message.get("role"), hash(content), hash(str(tool_calls)) if tool_calls else 0)
+
+
+def _has_block(message: dict, block_type: str) -> bool:
+    content = message.get("content")
+    return isinstance(content, list) and any(
+        isinstance(part, dict) and part.get("type") == block_type for part in content
+    )
+
+
+def message_units(messages: list, start: int) -> list:
+    """
+    Split messages[start:] into (start, end) units that are kept or dropped
+    together: an assistant turn with tool calls stays with the tool results
+    answering it (OpenAI `tool_calls` + `tool` messages, or `tool_use` +
+    `tool_result` blocks)
+    """
+    units = []
+    index = start
+    while index < len(messages):
+        message = messages[index]
+        end = index + 1
+        if message.get("tool_calls"):
+            while end < len(messages) and messages[end].get("role") == "tool":
+                end += 1
+        elif _has_block(message, "tool_use"):
+            while end < len(messages) and _has_block(messages[end], "tool_result"):
+                end += 1
+        if units and (message.get("role") == "tool" or _has_block(message, "tool_result")):
+            # A result separated from its call still belongs to the previous unit
+            units[-1] = (units[-1][0], end)
+        else:
+            units.append((index, end))
+        index = end
+    return units
+
+
+def trim_messages(messages: list, counts: list, budget: int) -> list:
+    """
+    Drop the oldest turns until the estimated prompt fits `budget` tokens
+
+    Leading system messages and the latest turn are always kept, and tool
+    calls are never separated from their results. The kept history starts
+    with a user turn, as some providers require.
+    """
+    total = sum(counts)
+    if total <= budget:
+        return messages
+
+    start = 0
+    while start < len(messages) and messages[start].get("role") == "system":
+        start += 1
+    units = message_units(messages, start)
+
+    first = 0
+    while first < len(units) - 1 and (
+        total > budget or messages[units[first][0]].get("role") != "user"
+    ):
+        unit_start, unit_end = units[first]
+        total -= sum(counts[unit_start:unit_end])
+        first += 1
+
+    if first == 0:
+        return messages
+    return messages[:start] + messages[units[first][0]:]
 
 
 class Pipeline:
@@ -24,6 +147,20 @@ class Pipeline:
         # The lower the number, the higher the priority.
         priority: int = 0
 
+        # Tags added to every request's LiteLLM metadata
+        tags: List[str] = DEFAULT_TAGS
+
+        # Stamp request start time, size and a trace id into the metadata, so the LiteLLM
+        # callbacks can measure the time spent between Open WebUI and LiteLLM. The token estimate
+        # (approx_prompt_tokens) comes from the per-message cache, so each turn only counts new messages
+        enrich_metadata: bool = True
+
+        # Drop the oldest turns of chats whose estimated prompt exceeds the model's budget.
+        # token_budgets maps model ids (fnmatch patterns allowed, e.g. "*gpt-4o*") to a token budget;
+        # models without a budget are left alone
+        trim_context: bool = False
+        token_budgets: Dict[str, int] = {}
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -44,6 +181,14 @@ class Pipeline:
         )
 
         self.chat_generations = {}
+        # user id -> (name, email, trace_user_id)
+        self.trace_users = {}
+        # message_key() -> estimated tokens, so each turn only counts the messages it adds
+        self.token_counts = {}
+        # model id -> token budget (None if unlimited), resolved from the token_budgets valve
+        self.model_budgets = {}
+        # Shared by every request; serialized as a JSON list on the way to LiteLLM
+        self.tags = tuple(sys.intern(tag) for tag in self.valves.tags)
         pass
 
     async def on_startup(self):
@@ -58,21 +203,84 @@ class Pipeline:
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
+        self.tags = tuple(sys.intern(tag) for tag in self.valves.tags)
+        self.model_budgets = {}
         pass
 
+    def count_tokens(self, messages: list) -> list:
+        # Estimated tokens per message
+        counts = []
+        for message in messages:
+            key = message_key(message)
+            tokens = self.token_counts.get(key)
+            if tokens is None:
+                tokens = message_tokens(message)
+                if len(self.token_counts) >= TOKEN_CACHE_SIZE:
+                    self.token_counts.clear()
+                self.token_counts[key] = tokens
+            counts.append(tokens)
+        return counts
+
+    def token_budget(self, model: str) -> Optional[int]:
+        if model in self.model_budgets:
+            return self.model_budgets[model]
+        budgets = self.valves.token_budgets
+        budget = budgets.get(model)
+        if budget is None:
+            budget = next(
+                (value for pattern, value in budgets.items() if fnmatch.fnmatchcase(model, pattern)), None
+            )
+        self.model_budgets[model] = budget
+        return budget
+
+    def trace_user_id(self, user: dict) -> str:
+        # Formatted once per user; a renamed user gets a fresh entry
+        name, email = user["name"], user["email"]
+        cached = self.trace_users.get(user.get("id"))
+        if cached is not None and cached[0] == name and cached[1] == email:
+            return cached[2]
+
+        trace_user_id = f"{name} / {email}"
+        if len(self.trace_users) >= TRACE_USER_CACHE_SIZE:
+            self.trace_users.clear()
+        self.trace_users[user.get("id")] = (name, email, trace_user_id)
+        return trace_user_id
+
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"inlet:{__name__}")
+        custom_metadata = body["custom_metadata"] = {}
 
-        if 'chat_id' in body['metadata']:
-            body["custom_metadata"] = {"session_id": body['metadata']['chat_id']}
+        metadata = body.get('metadata') or {}
+        if 'chat_id' in metadata:
+            custom_metadata["session_id"] = metadata['chat_id']
 
             if user := user if user else body.get("user"):
-                body["custom_metadata"]["trace_user_id"] = f'{user["name"]} / {user["email"]}'
+                custom_metadata["trace_user_id"] = self.trace_user_id(user)
             else:
-                print(f"Error: user & body[\"user\"] are both None")
+                logger.warning("user & body[\"user\"] are both None")
         else:
-            print("Error: can't find 'chat_id' in 'body'")
+            logger.warning("can't find 'chat_id' in 'body'")
+
+        custom_metadata["tags"] = self.tags
+
+        messages = body.get("messages") or []
+        counts = None
+        if self.valves.trim_context and messages:
+            budget = self.token_budget(body.get("model", ""))
+            if budget is not None:
+                counts = self.count_tokens(messages)
+                trimmed = trim_messages(messages, counts, budget)
+                if trimmed is not messages:
+                    custom_metadata["trimmed_messages"] = len(messages) - len(trimmed)
+                    body["messages"] = messages = trimmed
+                    # Every kept message is already in the token cache
+                    counts = self.count_tokens(messages)
 
-        body["custom_metadata"]["tags"] = ["litellm-openwebui.changchiyou.com"]
+        if self.valves.enrich_metadata:
+            # Wall clock time: monotonic clocks are not comparable across containers
+            custom_metadata["request_start_time"] = time.time()
+            custom_metadata["message_count"] = len(messages)
+            custom_metadata["approx_prompt_tokens"] = sum(counts if counts is not None else self.count_tokens(messages))
+            # 128-bit id in W3C trace-id form; does not need to be unguessable, so no os.urandom per request
+            custom_metadata["trace_id"] = f"{random.getrandbits(128):032x}"
 
         return body
@@ -5,23 +5,369 @@ date: 2024-05-30
 version: 1.0.1
 license: MIT
 description: A manifold pipeline that uses LiteLLM.
+requirements: aiohttp
 """
 
 from typing import List, Union, Generator, Iterator
 from schemas import OpenAIChatMessage
 from pydantic import BaseModel
+from collections import OrderedDict
+from concurrent.futures import Future
+from logging.handlers import QueueHandler, QueueListener
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+import aiohttp
+import asyncio
+import hashlib
+import json
+import logging
+import queue
+import random
 import requests
+import sys
+import threading
+import time
 import os
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; `extra={"fields": {...}}` adds structured fields
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+logger = logging.getLogger("litellm_manifold_pipeline")
+
+
+def start_logging():
+    # Worker threads only enqueue records; a background listener writes them to stdout.
+    # Idempotent, since pipelines may load this module more than once.
+    if getattr(logger, "queue_listener", None) is not None:
+        return
+    records = queue.SimpleQueue()
+    stdout = logging.StreamHandler(sys.stdout)
+    stdout.setFormatter(JsonFormatter())
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(records))
+    logger.propagate = False
+    logger.queue_listener = QueueListener(records, stdout)
+    logger.queue_listener.start()
+
+
+def stop_logging():
+    # Flushes the records still queued
+    listener, logger.queue_listener = getattr(logger, "queue_listener", None), None
+    if listener is not None:
+        listener.stop()
+
+
+def truncate(text: str, limit: int) -> str:
+    if not isinstance(text, str) or len(text) <= limit:
+        return text
+    return f"{text[:limit]}… ({len(text)} chars)"
+
+
+class StreamTimings:
+    # Time to first token and time between chunks, over all streams since startup
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = 0
+        self.ttft_total = 0.0
+        self.ttft_max = 0.0
+        self.gaps = 0
+        self.gap_total = 0.0
+        self.gap_max = 0.0
+
+    def record(self, ttft: float, gap_total: float, gap_max: float, gaps: int):
+        with self.lock:
+            self.streams += 1
+            self.ttft_total += ttft
+            self.ttft_max = max(self.ttft_max, ttft)
+            self.gaps += gaps
+            self.gap_total += gap_total
+            self.gap_max = max(self.gap_max, gap_max)
+
+    def summary(self) -> str:
+        with self.lock:
+            return (
+                f"streams={self.streams} "
+                f"ttft_avg={self.ttft_total / max(self.streams, 1):.3f}s ttft_max={self.ttft_max:.3f}s "
+                f"gap_avg={self.gap_total / max(self.gaps, 1) * 1000:.1f}ms gap_max={self.gap_max * 1000:.1f}ms"
+            )
+
+
+# Marks the end of a stream in the chunk buffer
+_STREAM_END = object()
+
+# Request fields forwarded to LiteLLM's /v1/chat/completions; everything else in the body
+# (Open WebUI's chat_id, user, title, custom_metadata, ...) stays behind
+PAYLOAD_FIELDS = frozenset({
+    "messages", "stream", "stream_options", "temperature", "top_p", "top_k", "n", "stop",
+    "max_tokens", "max_completion_tokens", "presence_penalty", "frequency_penalty",
+    "logit_bias", "logprobs", "top_logprobs", "seed", "response_format",
+    "tools", "tool_choice", "parallel_tool_calls", "functions", "function_call",
+    "reasoning_effort", "modalities", "audio", "prediction", "web_search_options",
+})
+
+
+def build_payload(body: dict, model: str, fields: frozenset = PAYLOAD_FIELDS) -> dict:
+    # Picks the allowed fields without copying the rest of the body (message lists are shared, not copied)
+    payload = {"model": model}
+    for key, value in body.items():
+        if key in fields:
+            payload[key] = value
+    if body.get("custom_metadata"):
+        payload["metadata"] = body["custom_metadata"]
+    return payload
+
+
+def dump_payload(payload: dict, sort_keys: bool = False) -> bytes:
+    # Serialized once, compact and without escaping non-ASCII text
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+        except TypeError:
+            pass
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys).encode("utf-8")
+
+
+def dump_keyed_payload(payload: dict) -> tuple:
+    # One canonical (sorted) dump serves as both the request body and its cache key:
+    # the key hashes everything that shapes the completion, metadata only tags who asked
+    request = {key: value for key, value in payload.items() if key != "metadata"}
+    data = dump_payload(request, sort_keys=True)
+    key = hashlib.blake2b(data, digest_size=16).hexdigest()
+    if "metadata" in payload:
+        data = data[:-1] + b',"metadata":' + dump_payload(payload["metadata"]) + b"}"
+    return data, key
+
+
+class CompletionCoalescer:
+    # Single-flight for identical non-streaming completions, with an optional short-lived response cache.
+    # Every caller gets the same result object, so fetch should return something immutable (the raw body)
+    def __init__(self, cache_size: int = 256):
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key: str, fetch, ttl: float = 0.0, coalesce: bool = True):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                if cached[0] > now:
+                    self.hits += 1
+                    self.cache.move_to_end(key)
+                    return cached[1]
+                del self.cache[key]
+
+            future = self.inflight.get(key) if coalesce else None
+            leader = future is None
+            if not leader:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                future = Future()
+                if coalesce:
+                    self.inflight[key] = future
+
+        # Followers wait for the leader's upstream call and share its response (or error)
+        if not leader:
+            return future.result()
+
+        try:
+            result = fetch()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            if ttl > 0:
+                with self.lock:
+                    self.cache[key] = (time.monotonic() + ttl, result)
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+            return result
+        finally:
+            if coalesce:
+                with self.lock:
+                    if self.inflight.get(key) is future:
+                        del self.inflight[key]
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def summary(self) -> str:
+        with self.lock:
+            return f"hits={self.hits} misses={self.misses} coalesced={self.coalesced} cached={len(self.cache)}"
+
+
+# Errors raised before the request reached LiteLLM, so it is safe to send it to another endpoint
+STREAM_CONNECT_ERRORS = (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)
+
+
+def connect_failed(error: requests.ConnectionError) -> bool:
+    # requests wraps urllib3's connect errors; anything else may have happened after the body was sent
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class Endpoint:
+    # Health of one LiteLLM base URL, guarded by EndpointPool.lock
+    __slots__ = ("url", "latency", "error_rate", "failures", "open_until", "inflight")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.latency = None         # EWMA of the response time (headers for streams), in seconds
+        self.error_rate = 0.0       # EWMA of failed requests
+        self.failures = 0           # Consecutive failures
+        self.open_until = 0.0       # Circuit breaker: skipped until this monotonic time
+        self.inflight = 0
+
+
+class EndpointPool:
+    """
+    LiteLLM base URLs with per-endpoint EWMA latency and error rate
+
+    `pick()` prefers the endpoint with the lowest expected latency (scaled by
+    in-flight requests and error rate). After `failure_threshold` consecutive
+    failures an endpoint is ejected for `cooldown` seconds, doubling while it
+    keeps failing; once the cooldown passes, one request probes it again.
+    Only failures to reach LiteLLM count: any HTTP response, including a 5xx
+    relayed from the provider, shows the endpoint is up.
+    """
+
+    ALPHA = 0.3
+
+    def __init__(self, urls: list, failure_threshold: int = 3, cooldown: float = 30.0, previous: "EndpointPool" = None):
+        self.lock = threading.Lock()
+        self.failure_threshold = max(failure_threshold, 1)
+        self.cooldown = cooldown
+        known = {endpoint.url: endpoint for endpoint in previous.endpoints} if previous is not None else {}
+        self.endpoints = [known.get(url) or Endpoint(url) for url in urls]
+
+    @staticmethod
+    def parse(urls: str) -> list:
+        return [url.strip().rstrip("/") for url in urls.split(",") if url.strip()]
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def pick(self, exclude: tuple = ()) -> Endpoint:
+        if not self.endpoints:
+            raise ValueError("LITELLM_BASE_URL not set. Please configure it in the valves.")
+        now = time.monotonic()
+        with self.lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude] or self.endpoints
+            healthy = [endpoint for endpoint in candidates if endpoint.open_until <= now]
+            if healthy:
+                # Unmeasured endpoints score 0, so new ones get traffic right away
+                endpoint = min(
+                    healthy,
+                    key=lambda e: (e.latency or 0.0) * (1 + e.inflight) * (1 + 4 * e.error_rate),
+                )
+                if endpoint.failures >= self.failure_threshold:
+                    # Half-open: let this request probe it while the others wait for the result
+                    endpoint.open_until = now + self.cooldown
+            else:
+                # Every endpoint is ejected: try the one that comes back first rather than failing outright
+                endpoint = min(candidates, key=lambda e: e.open_until)
+            endpoint.inflight += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint):
+        # The request was abandoned before it said anything about the endpoint
+        with self.lock:
+            endpoint.inflight -= 1
+
+    def record(self, endpoint: Endpoint, latency: float, ok: bool, release: bool = True):
+        # Streams keep the endpoint in flight (release=False) until they are released at their end
+        with self.lock:
+            if release:
+                endpoint.inflight -= 1
+            endpoint.error_rate += self.ALPHA * ((0.0 if ok else 1.0) - endpoint.error_rate)
+            if ok:
+                endpoint.latency = latency if endpoint.latency is None else (
+                    endpoint.latency + self.ALPHA * (latency - endpoint.latency)
+                )
+                endpoint.failures = 0
+                endpoint.open_until = 0.0
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self.failure_threshold:
+                backoff = 2 ** min(endpoint.failures - self.failure_threshold, 5)
+                endpoint.open_until = time.monotonic() + self.cooldown * backoff
+
+    def summary(self) -> str:
+        now = time.monotonic()
+        with self.lock:
+            return " ".join(
+                f"{e.url}[latency={(e.latency or 0) * 1000:.0f}ms errors={e.error_rate:.0%}"
+                f"{' open' if e.open_until > now else ''}]"
+                for e in self.endpoints
+            )
+
+
+# Last /v1/models response, next to the pipeline (pipelines only loads .py files from here)
+MODELS_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "litellm_models_cache.json")
+
 
 class Pipeline:
 
     class Valves(BaseModel):
+        # One or more LiteLLM proxies, comma separated; requests go to the fastest healthy one
         LITELLM_BASE_URL: str = ""
         LITELLM_API_KEY: str = ""
+        # Logs request contents and per-request timings; otherwise only sampled request summaries and errors
         LITELLM_PIPELINE_DEBUG: bool = False
+        # Fraction of requests logged (errors are always logged)
+        LOG_SAMPLE_RATE: float = 1.0
+        # Logged user messages are cut to this many characters
+        LOG_MAX_CHARS: int = 200
         HIDDEN_LIST: list[str] = []
         REPLACE_PREFIX: str = ""
+        # Keep-alive connections kept per LiteLLM host (and max concurrent requests per host)
+        POOL_SIZE: int = 32
+        # Seconds to wait for a connection / between bytes of the response
+        CONNECT_TIMEOUT: float = 5.0
+        READ_TIMEOUT: float = 300.0
+        # Consecutive failures that eject an endpoint, and the seconds it stays ejected
+        CIRCUIT_BREAKER_FAILURES: int = 3
+        CIRCUIT_BREAKER_COOLDOWN: float = 30.0
+        # Request fields forwarded besides PAYLOAD_FIELDS (e.g. provider specific parameters)
+        EXTRA_PAYLOAD_FIELDS: list[str] = []
+        # Share one upstream call between identical concurrent non-streaming requests (titles, tags, autocomplete)
+        COALESCE_REQUESTS: bool = True
+        # Seconds identical non-streaming responses are served from memory (0 disables the cache)
+        RESPONSE_CACHE_TTL: float = 0.0
+        # Seconds the model list is served before it is refreshed in the background
+        MODELS_TTL: float = 300.0
+        # "async" forwards streams through aiohttp with a bounded buffer, "sync" iterates the requests response
+        STREAM_MODE: str = "async"
+        # SSE lines buffered ahead of Open WebUI before reading from LiteLLM pauses
+        STREAM_BUFFER_SIZE: int = 64
 
     def __init__(self):
         # You can also set the pipelines that are available in this pipeline.
@@ -46,108 +392,463 @@ class Pipeline:
                     "LITELLM_BASE_URL", "http://localhost:4001"
                 ),
                 "LITELLM_API_KEY": os.getenv("LITELLM_API_KEY", "your-api-key-here"),
-                "LITELLM_PIPELINE_DEBUG": os.getenv("LITELLM_PIPELINE_DEBUG", True),
+                "LITELLM_PIPELINE_DEBUG": os.getenv("LITELLM_PIPELINE_DEBUG", "false").lower() == "true",
+                "LOG_SAMPLE_RATE": os.getenv("LITELLM_LOG_SAMPLE_RATE", 1.0),
+                "LOG_MAX_CHARS": os.getenv("LITELLM_LOG_MAX_CHARS", 200),
                 "HIDDEN_LIST": os.getenv("HIDDEN_LIST", "").split(","),
-                "REPLACE_PREFIX": os.getenv("REPLACE_PREFIX", "")
+                "REPLACE_PREFIX": os.getenv("REPLACE_PREFIX", ""),
+                "POOL_SIZE": os.getenv("LITELLM_POOL_SIZE", 32),
+                "CONNECT_TIMEOUT": os.getenv("LITELLM_CONNECT_TIMEOUT", 5.0),
+                "READ_TIMEOUT": os.getenv("LITELLM_READ_TIMEOUT", 300.0),
+                "MODELS_TTL": os.getenv("LITELLM_MODELS_TTL", 300.0),
+                "CIRCUIT_BREAKER_FAILURES": os.getenv("LITELLM_CIRCUIT_BREAKER_FAILURES", 3),
+                "CIRCUIT_BREAKER_COOLDOWN": os.getenv("LITELLM_CIRCUIT_BREAKER_COOLDOWN", 30.0),
+                "COALESCE_REQUESTS": os.getenv("LITELLM_COALESCE_REQUESTS", True),
+                "RESPONSE_CACHE_TTL": os.getenv("LITELLM_RESPONSE_CACHE_TTL", 0.0),
+                "STREAM_MODE": os.getenv("LITELLM_STREAM_MODE", "async"),
+                "STREAM_BUFFER_SIZE": os.getenv("LITELLM_STREAM_BUFFER_SIZE", 64),
             }
         )
-        # Get models on initialization
-        self.pipelines = self.get_litellm_models()
+        start_logging()
+        logger.setLevel(logging.DEBUG if self.valves.LITELLM_PIPELINE_DEBUG else logging.INFO)
+        # Shared keep-alive HTTP session, created on first use (see get_session)
+        self.session = None
+        self.session_pool_size = None
+        self.session_lock = threading.Lock()
+        # Event loop thread and aiohttp session of the async stream mode, started on first use
+        self.stream_loop = None
+        self.stream_session = None
+        self.stream_timings = StreamTimings()
+        self.payload_fields = PAYLOAD_FIELDS | frozenset(self.valves.EXTRA_PAYLOAD_FIELDS)
+        self.coalescer = CompletionCoalescer()
+        self.endpoints = self.build_endpoints()
+        # Cached /v1/models response: {"base_url", "etag", "fetched_at", "data"}
+        self.models_cache = None
+        self.models_checked_at = float("-inf")
+        self.models_refreshing = False
+        self.models_lock = threading.Lock()
+        # Serializes refreshes, so only one of them writes the cache file at a time
+        self.models_refresh_lock = threading.Lock()
+        # Serve the last known models right away; on_startup refreshes them
+        self.pipelines = []
+        self.load_models_cache()
         pass
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
-        # Get models on startup
-        self.pipelines = self.get_litellm_models()
+        start_logging()
+        logger.info(f"on_startup:{__name__}")
+        # Get models on startup, unless they are already known
+        if self.models_cache is None:
+            await asyncio.to_thread(self.refresh_models)
+        else:
+            self.maybe_refresh_models()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
+        logger.info(f"on_shutdown:{__name__}")
+        self.close_session()
+        self.close_stream_session(stop_loop=True)
+        stop_logging()
         pass
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
+        logger.setLevel(logging.DEBUG if self.valves.LITELLM_PIPELINE_DEBUG else logging.INFO)
 
-        self.pipelines = self.get_litellm_models()
+        # Resize the connection pools if POOL_SIZE changed
+        if self.session_pool_size != self.valves.POOL_SIZE:
+            self.close_session()
+            self.close_stream_session()
+        self.payload_fields = PAYLOAD_FIELDS | frozenset(self.valves.EXTRA_PAYLOAD_FIELDS)
+        self.coalescer.clear()
+        self.endpoints = self.build_endpoints(self.endpoints)
+        # The URL, key or filters may have changed
+        if self.models_cache is not None and self.models_cache.get("base_url") != self.valves.LITELLM_BASE_URL:
+            self.models_cache = None
+        await asyncio.to_thread(self.refresh_models)
         pass
 
-    def get_litellm_models(self):
+    def get_session(self) -> requests.Session:
+        # One session for all requests, so connections to LiteLLM are reused across chats
+        with self.session_lock:
+            if self.session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=4,
+                    pool_maxsize=self.valves.POOL_SIZE,
+                    pool_block=False,
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.session = session
+                self.session_pool_size = self.valves.POOL_SIZE
+            return self.session
+
+    def close_session(self):
+        # Requests still streaming from the old session keep their connection until they finish
+        with self.session_lock:
+            session, self.session = self.session, None
+        if session is not None:
+            session.close()
+
+    def timeout(self) -> tuple:
+        return (self.valves.CONNECT_TIMEOUT, self.valves.READ_TIMEOUT)
+
+    def build_endpoints(self, previous: EndpointPool = None) -> EndpointPool:
+        # Endpoints kept across valve updates keep their statistics
+        return EndpointPool(
+            EndpointPool.parse(self.valves.LITELLM_BASE_URL),
+            self.valves.CIRCUIT_BREAKER_FAILURES,
+            self.valves.CIRCUIT_BREAKER_COOLDOWN,
+            previous,
+        )
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        r, _ = self.send(method, path, **kwargs)
+        return r
+
+    def send(self, method: str, path: str, stream: bool = False, **kwargs) -> tuple:
+        # Sends the request to the best endpoint, failing over to the next one only when it could
+        # not be reached, so a request LiteLLM may have started on is never sent twice.
+        # A streamed response keeps its endpoint in flight: the caller releases it at the end.
+        pool = self.endpoints
+        tried = []
+        while True:
+            endpoint = pool.pick(tuple(tried))
+            tried.append(endpoint)
+            can_fail_over = len(tried) < len(pool)
+            started = time.perf_counter()
+            try:
+                r = self.get_session().request(
+                    method, endpoint.url + path, timeout=self.timeout(), stream=stream, **kwargs
+                )
+            except requests.ConnectionError as e:
+                pool.record(endpoint, time.perf_counter() - started, ok=False)
+                if can_fail_over and connect_failed(e):
+                    continue
+                raise
+            except Exception:
+                pool.record(endpoint, time.perf_counter() - started, ok=False)
+                raise
+            pool.record(endpoint, time.perf_counter() - started, ok=True, release=not stream)
+            return r, endpoint
+
+    def stream_sync(self, path: str, data: bytes, headers: dict) -> Generator:
+        # The request is only sent on the first read, so a stream the client never starts
+        # holds neither a connection nor an in-flight slot of its endpoint
+        try:
+            r, endpoint = self.send("POST", path, stream=True, data=data, headers=headers)
+        except Exception as e:
+            logger.error("stream failed", extra={"fields": {"error": truncate(str(e), 500)}})
+            yield f"Error: {e}"
+            return
+        try:
+            r.raise_for_status()
+            yield from r.iter_lines()
+        except Exception as e:
+            logger.error("stream failed", extra={"fields": {"error": truncate(str(e), 500)}})
+            yield f"Error: {e}"
+        finally:
+            # Also runs on GeneratorExit when the client disconnects
+            r.close()
+            self.endpoints.release(endpoint)
+
+    def get_stream_loop(self) -> asyncio.AbstractEventLoop:
+        # pipe() runs in a worker thread, so async streams are driven by a loop of their own
+        with self.session_lock:
+            if self.stream_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="litellm-stream", daemon=True).start()
+                self.stream_loop = loop
+            return self.stream_loop
+
+    def close_stream_session(self, stop_loop: bool = False):
+        # Streams still open on the old session end with an error; the next one opens a new session
+        with self.session_lock:
+            loop = self.stream_loop
+            session, self.stream_session = self.stream_session, None
+            if stop_loop:
+                self.stream_loop = None
+        if loop is None:
+            return
+        if session is not None:
+            asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=5)
+        if stop_loop:
+            loop.call_soon_threadsafe(loop.stop)
+
+    def get_stream_session(self) -> aiohttp.ClientSession:
+        # Only called on the stream loop, which owns the session
+        if self.stream_session is None:
+            self.stream_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.valves.POOL_SIZE),
+                timeout=aiohttp.ClientTimeout(
+                    connect=self.valves.CONNECT_TIMEOUT, sock_read=self.valves.READ_TIMEOUT
+                ),
+            )
+        return self.stream_session
+
+    async def open_stream(self, path: str, data: bytes, headers: dict) -> tuple:
+        # Same endpoint choice and failover as send(), up to the response headers
+        pool = self.endpoints
+        tried = []
+        while True:
+            endpoint = pool.pick(tuple(tried))
+            tried.append(endpoint)
+            can_fail_over = len(tried) < len(pool)
+            started = time.perf_counter()
+            try:
+                r = await self.get_stream_session().post(endpoint.url + path, data=data, headers=headers)
+            except asyncio.CancelledError:
+                pool.release(endpoint)
+                raise
+            except aiohttp.ClientConnectionError as e:
+                pool.record(endpoint, time.perf_counter() - started, ok=False)
+                if can_fail_over and isinstance(e, STREAM_CONNECT_ERRORS):
+                    continue
+                raise
+            except Exception:
+                pool.record(endpoint, time.perf_counter() - started, ok=False)
+                raise
+            pool.record(endpoint, time.perf_counter() - started, ok=True, release=False)
+            return r, endpoint
+
+    async def forward_stream(self, path: str, data: bytes, headers: dict, chunks: asyncio.Queue):
+        # Put the SSE lines of LiteLLM's response into `chunks`; a full buffer pauses reading
+        started = time.perf_counter()
+        first = last = None
+        gap_total = gap_max = 0.0
+        gaps = 0
+        endpoint = None
+        try:
+            r, endpoint = await self.open_stream(path, data, headers)
+            async with r:
+                r.raise_for_status()
+                async for line in r.content:
+                    line = line.rstrip(b"\r\n")
+                    if not line:
+                        continue
+                    now = time.perf_counter()
+                    if first is None:
+                        first = now
+                    else:
+                        gap = now - last
+                        gap_total += gap
+                        gap_max = max(gap_max, gap)
+                        gaps += 1
+                    last = now
+                    await chunks.put(line)
+            await chunks.put(_STREAM_END)
+        except asyncio.CancelledError:
+            # Open WebUI stopped reading: leaving the `async with` drops the connection,
+            # which makes LiteLLM abort the upstream request
+            raise
+        except Exception as e:
+            logger.error("stream failed", extra={"fields": {"error": truncate(str(e), 500)}})
+            await chunks.put(e)
+        finally:
+            if endpoint is not None:
+                self.endpoints.release(endpoint)
+            if first is not None:
+                self.stream_timings.record(first - started, gap_total, gap_max, gaps)
+                logger.debug(
+                    "stream",
+                    extra={"fields": {
+                        "ttft_s": round(first - started, 3),
+                        "chunks": gaps + 1,
+                        "gap_max_ms": round(gap_max * 1000, 1),
+                        "totals": self.stream_timings.summary(),
+                    }},
+                )
+
+    def stream_async(self, path: str, data: bytes, headers: dict) -> Generator:
+        loop = self.get_stream_loop()
+        chunks = asyncio.Queue(maxsize=max(self.valves.STREAM_BUFFER_SIZE, 1))
+        # asyncio.Queue binds to the running loop on first use, so it must only be touched from there
+        producer = asyncio.run_coroutine_threadsafe(
+            self.forward_stream(path, data, headers, chunks), loop
+        )
+        try:
+            while True:
+                chunk = asyncio.run_coroutine_threadsafe(chunks.get(), loop).result()
+                if chunk is _STREAM_END:
+                    break
+                if isinstance(chunk, Exception):
+                    yield f"Error: {chunk}"
+                    break
+                yield chunk
+        finally:
+            # Also runs on GeneratorExit when the client disconnects
+            producer.cancel()
+
+    def filter_models(self, models: list) -> list:
+        prefix = self.valves.REPLACE_PREFIX
+        hidden = frozenset(self.valves.HIDDEN_LIST) | {"*"}
 
         def strip_prefix(model_id: str) -> str:
-            if model_id.startswith(self.valves.REPLACE_PREFIX):
-                model_id = model_id.replace(self.valves.REPLACE_PREFIX, "")
+            if model_id.startswith(prefix):
+                model_id = model_id.replace(prefix, "")
             return model_id
 
+        pipelines = []
+        for model in models:
+            model_id = strip_prefix(model["id"])
+            if model_id not in hidden:
+                pipelines.append({"id": model_id, "name": strip_prefix(model.get("name", model["id"]))})
+        return pipelines
+
+    def load_models_cache(self):
+        # Last known model list, so a cold start serves models without waiting for LiteLLM
+        try:
+            with open(MODELS_CACHE_PATH, encoding="utf-8") as f:
+                cache = json.load(f)
+            if cache.get("base_url") != self.valves.LITELLM_BASE_URL:
+                return
+            pipelines = self.filter_models(cache["data"])
+            fetched_at = float(cache.get("fetched_at", 0))
+        except FileNotFoundError:
+            # Nothing cached yet on a first start
+            return
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            # Unreadable or malformed file: ignore it, on_startup fetches the models again
+            logger.warning(
+                "models cache ignored", extra={"fields": {"path": MODELS_CACHE_PATH, "error": truncate(repr(e), 500)}}
+            )
+            return
+        self.models_cache = cache
+        self.models_checked_at = time.monotonic() - max(time.time() - fetched_at, 0)
+        self.pipelines = pipelines
+
+    def save_models_cache(self):
+        tmp_path = f"{MODELS_CACHE_PATH}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.models_cache, f)
+            os.replace(tmp_path, MODELS_CACHE_PATH)
+        except OSError as e:
+            logger.error(
+                "models cache save failed", extra={"fields": {"path": MODELS_CACHE_PATH, "error": truncate(str(e), 500)}}
+            )
+
+    def maybe_refresh_models(self):
+        # Stale-while-revalidate: callers keep the cached list while a background thread refreshes it
+        if time.monotonic() - self.models_checked_at < self.valves.MODELS_TTL:
+            return
+        with self.models_lock:
+            if self.models_refreshing:
+                return
+            self.models_refreshing = True
+        threading.Thread(target=self.refresh_models, name="litellm-models", daemon=True).start()
+
+    def refresh_models(self):
+        with self.models_lock:
+            self.models_refreshing = True
+        try:
+            with self.models_refresh_lock:
+                self.pipelines = self.fetch_models()
+        finally:
+            self.models_checked_at = time.monotonic()
+            with self.models_lock:
+                self.models_refreshing = False
+
+    def fetch_models(self) -> list:
+        if not self.valves.LITELLM_BASE_URL:
+            logger.warning("LITELLM_BASE_URL not set. Please configure it in the valves.")
+            return []
+
         headers = {}
         if self.valves.LITELLM_API_KEY:
             headers["Authorization"] = f"Bearer {self.valves.LITELLM_API_KEY}"
 
-        if self.valves.LITELLM_BASE_URL:
-            try:
-                r = requests.get(
-                    f"{self.valves.LITELLM_BASE_URL}/v1/models", headers=headers
-                )
-                models = r.json()
-                print(models)
-                return [
-                    {
-                        "id": strip_prefix(model["id"]),
-                        "name": strip_prefix(model.get("name", model["id"])),
-                    }
-                    for model in models["data"]
-                    if strip_prefix(model["id"]) not in self.valves.HIDDEN_LIST + ["*"]
-                ]
-            except Exception as e:
-                print(f"Error fetching models from LiteLLM: {e}")
-                return [
-                    {
-                        "id": "error",
-                        "name": "Could not fetch models from LiteLLM, please update the URL in the valves.",
-                    },
-                ]
-        else:
-            print("LITELLM_BASE_URL not set. Please configure it in the valves.")
-            return []
+        cache = self.models_cache
+        if cache is not None and cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+
+        try:
+            r = self.request("GET", "/v1/models", headers=headers)
+            if r.status_code == 304 and cache is not None:
+                cache["fetched_at"] = time.time()
+                self.save_models_cache()
+                return self.filter_models(cache["data"])
+            r.raise_for_status()
+            models = r.json()["data"]
+        except Exception as e:
+            logger.error("models fetch failed", extra={"fields": {"error": truncate(str(e), 500)}})
+            if cache is not None:
+                return self.pipelines
+            return [
+                {
+                    "id": "error",
+                    "name": "Could not fetch models from LiteLLM, please update the URL in the valves.",
+                },
+            ]
+
+        self.models_cache = {
+            "base_url": self.valves.LITELLM_BASE_URL,
+            "etag": r.headers.get("ETag"),
+            "fetched_at": time.time(),
+            "data": models,
+        }
+        self.save_models_cache()
+        return self.filter_models(models)
 
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
-        if "user" in body:
-            print("######################################")
-            print(f'# User: {body["user"]["name"]} / {body["user"]["email"]}')
-            print(f"# Message: {user_message}")
-            print(f"# Model ID: {model_id}")
-            print("######################################")
+        debug = self.valves.LITELLM_PIPELINE_DEBUG
+        if debug or random.random() < self.valves.LOG_SAMPLE_RATE:
+            fields = {"model": model_id, "stream": body.get("stream", False), "messages": len(messages)}
+            if "user" in body:
+                fields["user"] = f'{body["user"]["name"]} / {body["user"]["email"]}'
+            if debug:
+                fields["message"] = truncate(user_message, self.valves.LOG_MAX_CHARS)
+            logger.info("request", extra={"fields": fields})
 
-        headers = {}
+        self.maybe_refresh_models()
+
+        headers = {"Content-Type": "application/json"}
         if self.valves.LITELLM_API_KEY:
             headers["Authorization"] = f"Bearer {self.valves.LITELLM_API_KEY}"
 
         try:
-            payload = {**body, "model": self.valves.REPLACE_PREFIX + model_id}
-
-            payload.pop("chat_id", None)
-            payload.pop("user", None)
-            payload.pop("title", None)
-            payload.pop("custom_metadata", None)
+            payload = build_payload(body, self.valves.REPLACE_PREFIX + model_id, self.payload_fields)
+            path = "/v1/chat/completions"
+            stream = body.get("stream", False)
+            shared = not stream and (self.valves.COALESCE_REQUESTS or self.valves.RESPONSE_CACHE_TTL > 0)
+            if shared:
+                data, key = dump_keyed_payload(payload)
+            else:
+                data = dump_payload(payload)
 
-            if body.get('custom_metadata'):
-                payload["metadata"] = body["custom_metadata"]
+            if stream and self.valves.STREAM_MODE == "async":
+                return self.stream_async(path, data, headers)
+            if stream:
+                return self.stream_sync(path, data, headers)
 
-            r = requests.post(
-                url=f"{self.valves.LITELLM_BASE_URL}/v1/chat/completions",
-                json=payload,
-                headers=headers,
-                stream=True,
-            )
+            def post():
+                r = self.request("POST", path, data=data, headers=headers)
+                r.raise_for_status()
+                return r
 
-            r.raise_for_status()
+            if not shared:
+                return post().json()
 
-            if body["stream"]:
-                return r.iter_lines()
-            else:
-                return r.json()
+            # Identical requests share the response, so the usage is billed to the first caller's metadata.
+            # The raw body is shared and parsed per caller, so no caller sees another one's edits
+            body = self.coalescer.get(
+                key,
+                lambda: post().content,
+                self.valves.RESPONSE_CACHE_TTL,
+                self.valves.COALESCE_REQUESTS,
+            )
+            response = json.loads(body)
+            if debug:
+                logger.debug(
+                    "completion",
+                    extra={"fields": {"coalescer": self.coalescer.summary(), "endpoints": self.endpoints.summary()}},
+                )
+            return response
         except Exception as e:
+            logger.error("request failed", extra={"fields": {"model": model_id, "error": truncate(str(e), 500)}})
             return f"Error: {e}"
@@ -0,0 +1,82 @@
+"""
+Offline benchmarks for the Chat Info Filter inlet (.data-pipelines/chat_info_filter_pipeline.py)
+
+Needs the filter's own requirement (pydantic):
+
+    pytest benchmarks/bench_chat_info_filter.py --benchmark-only
+
+or, without pytest-benchmark installed:
+
+    python benchmarks/bench_chat_info_filter.py [--requests 1000] [--users 50]
+"""
+
+import asyncio
+import os
+import random
+import statistics
+
+from runner import load_module, main
+
+REQUEST_COUNT = int(os.getenv("BENCH_REQUEST_COUNT", "1000"))
+USER_COUNT = int(os.getenv("BENCH_USER_COUNT", "50"))
+
+
+chat_info_filter = load_module("chat_info_filter_pipeline", ".data-pipelines", "chat_info_filter_pipeline.py")
+
+
+def make_requests(count: int = None, users: int = None, seed: int = 0) -> list:
+    """(body, user) pairs as Open WebUI sends them to the filter, spread over a few users and chats"""
+    count = count or REQUEST_COUNT
+    users = users or USER_COUNT
+    rnd = random.Random(seed)
+    known_users = [
+        {"id": f"user-{index}", "name": f"使用者 {index}", "email": f"user{index}@example.com", "role": "user"}
+        for index in range(users)
+    ]
+    requests = []
+    for _ in range(count):
+        user = rnd.choice(known_users)
+        chat_id = f"chat-{rnd.randint(0, users * 4)}"
+        body = {
+            "model": "claude-4.5-sonnet",
+            "stream": True,
+            "messages": [{"role": "user", "content": "Hello"}],
+            "user": user,
+            "metadata": {"chat_id": chat_id, "message_id": "m", "session_id": "s", "user_id": user["id"]},
+        }
+        requests.append((body, user))
+    return requests
+
+
+def _run_inlet(benchmark, enrich_metadata: bool):
+    requests = make_requests()
+    pipeline = chat_info_filter.Pipeline()
+    pipeline.valves.enrich_metadata = enrich_metadata
+    loop = asyncio.new_event_loop()
+
+    async def inlet_all():
+        for body, user in requests:
+            await pipeline.inlet(body, user)
+
+    try:
+        benchmark(lambda: loop.run_until_complete(inlet_all()))
+    finally:
+        loop.close()
+
+
+def test_inlet(benchmark):
+    _run_inlet(benchmark, enrich_metadata=True)
+
+
+def test_inlet_without_enrichment(benchmark):
+    # Trace ids and tags only, as the filter did before it counted prompt tokens
+    _run_inlet(benchmark, enrich_metadata=False)
+
+
+if __name__ == "__main__":
+    main(
+        globals(),
+        {"REQUEST_COUNT": ("--requests", "inlet calls per round"), "USER_COUNT": ("--users", "distinct users sending them")},
+        summary=lambda: print(f"requests: {REQUEST_COUNT} per round | users: {USER_COUNT}"),
+        throughput=lambda benchmark: f"{REQUEST_COUNT / statistics.median(benchmark.timings):,.0f} inlet calls/s",
+    )
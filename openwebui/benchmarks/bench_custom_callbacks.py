@@ -0,0 +1,273 @@
+"""
+Offline benchmarks for the LiteLLM custom callback handler (litellm/custom_callbacks.py)
+
+LiteLLM is replaced by stub modules, so neither the proxy nor network access is needed.
+The benchmarks use the `benchmark` fixture of pytest-benchmark:
+
+    pytest benchmarks/bench_custom_callbacks.py --benchmark-only
+
+or, without pytest-benchmark installed, a minimal runner with the same interface:
+
+    python benchmarks/bench_custom_callbacks.py [--keys 4000] [--messages 400]
+"""
+
+import asyncio
+import logging
+import os
+import random
+import sys
+import types
+
+from runner import load_module, main
+
+PRICE_TABLE_SIZE = int(os.getenv("BENCH_PRICE_TABLE_SIZE", "4000"))
+TRANSCRIPT_SIZE = int(os.getenv("BENCH_TRANSCRIPT_SIZE", "400"))
+
+
+def _install_litellm_stubs():
+    """Register the minimal litellm surface custom_callbacks.py imports"""
+    litellm = types.ModuleType("litellm")
+    litellm.model_cost = {}
+
+    # Records are still created (as in the proxy) but never written out
+    logger = logging.getLogger("LiteLLM Proxy (benchmark)")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logging_module = types.ModuleType("litellm._logging")
+    logging_module.verbose_proxy_logger = logger
+
+    integrations = types.ModuleType("litellm.integrations")
+    custom_logger = types.ModuleType("litellm.integrations.custom_logger")
+    custom_logger.CustomLogger = type("CustomLogger", (), {})
+
+    proxy = types.ModuleType("litellm.proxy")
+    proxy_server = types.ModuleType("litellm.proxy.proxy_server")
+    proxy_server.UserAPIKeyAuth = type("UserAPIKeyAuth", (), {})
+    proxy_server.DualCache = type("DualCache", (), {})
+
+    sys.modules.update({
+        "litellm": litellm,
+        "litellm._logging": logging_module,
+        "litellm.integrations": integrations,
+        "litellm.integrations.custom_logger": custom_logger,
+        "litellm.proxy": proxy,
+        "litellm.proxy.proxy_server": proxy_server,
+    })
+    return litellm
+
+
+def _load_callbacks():
+    os.environ.setdefault("CUSTOM_METRICS_PORT", "0")  # no metrics endpoint per benchmark handler
+    litellm = _install_litellm_stubs()
+    return litellm, load_module("custom_callbacks", "litellm", "custom_callbacks.py")
+
+
+litellm, custom_callbacks = _load_callbacks()
+
+
+def make_price_table(size: int = None, seed: int = 0) -> dict:
+    """Build a price table shaped like litellm.model_cost (provider prefixes, versions, dates)"""
+    size = size or PRICE_TABLE_SIZE
+    rnd = random.Random(seed)
+    providers = [
+        "", "openai/", "azure/", "azure_ai/", "bedrock/", "bedrock/us.", "vertex_ai/", "anthropic/",
+        "gemini/", "groq/", "together_ai/", "openrouter/", "deepinfra/", "fireworks_ai/", "mistral/",
+    ]
+    families = [
+        "gpt", "claude", "gemini", "llama", "mistral", "qwen", "deepseek", "command", "nova",
+        "phi", "grok", "gemma", "mixtral", "jamba", "titan", "o1", "o3",
+    ]
+    versions = ["3", "3.5", "3-5", "4", "4o", "4.1", "4.5", "4-5", "2.0", "2.5", "1.5", "70b", "8b", "405b", "v2"]
+    variants = ["", "-mini", "-pro", "-flash", "-sonnet", "-haiku", "-opus", "-turbo", "-instruct", "-chat", "-nano"]
+    suffixes = ["", "-20240620", "-20241022", "-20250219", "-0125", "-preview", "-latest", "-v1:0", "-exp"]
+
+    table = {}
+    while len(table) < size:
+        key = (
+            rnd.choice(providers) + rnd.choice(families) + "-" + rnd.choice(versions)
+            + rnd.choice(variants) + rnd.choice(suffixes)
+        )
+        table[key] = {
+            "input_cost_per_token": rnd.uniform(1e-8, 1e-5),
+            "output_cost_per_token": rnd.uniform(1e-8, 3e-5),
+            "litellm_provider": key.split("/")[0] if "/" in key else "openai",
+            "mode": "chat",
+        }
+    return table
+
+
+def make_model_names(price_table: dict, count: int = 200, seed: int = 1) -> list:
+    """Model names as the proxy sees them: wildcard `openai/*` names, renamed deployments, unknown models"""
+    rnd = random.Random(seed)
+    keys = list(price_table)
+    names = []
+    for _ in range(count):
+        key = rnd.choice(keys)
+        roll = rnd.random()
+        if roll < 0.3:
+            names.append(key.split("/")[-1])
+        elif roll < 0.5:
+            names.append(key.split("/")[-1].replace("-", "."))
+        elif roll < 0.7:
+            names.append(key.split("/")[-1] + "-gmi-ray")
+        elif roll < 0.85:
+            names.append(f"cybertron-{rnd.randint(0, 9999):04d}")
+        else:
+            names.append(key)
+    return names
+
+
+def make_transcript(size: int = None, duplicate_ratio: float = 0.05, seed: int = 2) -> list:
+    """An agentic transcript: alternating tool_use / tool_result turns with a few resent tool_results"""
+    size = size or TRANSCRIPT_SIZE
+    rnd = random.Random(seed)
+    messages = [{"role": "system", "content": "You are a coding agent."}]
+    results = []
+    for turn in range(size // 2):
+        tool_use_id = f"toolu_{turn:06d}"
+        messages.append({
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": "Running the next step."},
+                {"type": "tool_use", "id": tool_use_id, "name": "bash", "input": {"command": "ls"}},
+            ],
+        })
+        result = {"type": "tool_result", "tool_use_id": tool_use_id, "content": "x" * rnd.randint(50, 2000)}
+        content = [result]
+        if results and rnd.random() < duplicate_ratio:
+            content.append(rnd.choice(results))
+        results.append(result)
+        messages.append({"role": "user", "content": content})
+    return messages
+
+
+def make_request(messages: list) -> dict:
+    return {
+        "model": "claude-4.5-sonnet",
+        "messages": messages,
+        "metadata": {"tags": ["litellm-openwebui.changchiyou.com"], "session_id": "benchmark"},
+        "proxy_server_request": {"headers": {"host": "litellm-proxy:8000"}},
+    }
+
+
+def _handler(price_table: dict):
+    litellm.model_cost = price_table
+    handler = custom_callbacks.MyCustomHandler()
+    handler.debug = False
+    return handler
+
+
+def test_price_index_build(benchmark):
+    price_table = make_price_table()
+
+    def build():
+        index = custom_callbacks.PriceTableIndex()
+        index.sync(price_table)
+        return index
+
+    benchmark.pedantic(build, rounds=10)
+
+
+def test_find_price_table_key_cold(benchmark):
+    price_table = make_price_table()
+    models = make_model_names(price_table)
+    handler = _handler(price_table)
+    handler._find_price_table_key(models[0])  # build the index outside of the measurement
+
+    def lookup_all():
+        handler.model_mapping_cache.clear()
+        for model in models:
+            handler._find_price_table_key(model)
+
+    benchmark(lookup_all)
+
+
+def test_find_price_table_key_warm(benchmark):
+    price_table = make_price_table()
+    models = make_model_names(price_table)
+    handler = _handler(price_table)
+    for model in models:
+        handler._find_price_table_key(model)
+
+    def lookup_all():
+        for model in models:
+            handler._find_price_table_key(model)
+
+    benchmark(lookup_all)
+
+
+def test_get_custom_pricing(benchmark):
+    price_table = make_price_table()
+    models = make_model_names(price_table) + ["primus-labor-70b", "smollm3-3b-gmi-ray"]
+    handler = _handler(price_table)
+    handler.pricing_config = custom_callbacks.PricingConfig(handler.pricing_config.path, default_multiplier=1.2)
+
+    def price_all():
+        for model in models:
+            handler._get_custom_pricing(model)
+
+    benchmark(price_all)
+
+
+def test_deduplicate_tool_results(benchmark):
+    messages = make_transcript()
+    handler = _handler({})
+
+    benchmark(handler._deduplicate_tool_results, messages)
+
+
+def test_deduplicate_tool_results_without_duplicates(benchmark):
+    messages = make_transcript(duplicate_ratio=0)
+    handler = _handler({})
+
+    benchmark(handler._deduplicate_tool_results, messages)
+
+
+def test_async_pre_call_hook(benchmark):
+    messages = make_transcript()
+    handler = _handler(make_price_table())
+    user_api_key_dict = custom_callbacks.UserAPIKeyAuth()
+    cache = custom_callbacks.DualCache()
+    loop = asyncio.new_event_loop()
+
+    def pre_call():
+        return loop.run_until_complete(
+            handler.async_pre_call_hook(user_api_key_dict, cache, make_request(messages), "completion")
+        )
+
+    try:
+        benchmark(pre_call)
+    finally:
+        loop.close()
+
+
+def test_async_log_success_event(benchmark):
+    handler = _handler(make_price_table())
+    kwargs = {
+        "model": "claude-4.5-sonnet",
+        "litellm_params": {"metadata": {"trace_user_id": "benchmark", "tags": ["litellm-openwebui.changchiyou.com"]}},
+    }
+    response_obj = {"usage": {"prompt_tokens": 1200, "completion_tokens": 300}}
+    loop = asyncio.new_event_loop()
+
+    async def log_batch():
+        for _ in range(100):
+            await handler.async_log_success_event(kwargs, response_obj, None, None)
+        await asyncio.sleep(0)  # let the aggregator drain its queue
+
+    try:
+        benchmark(lambda: loop.run_until_complete(log_batch()))
+    finally:
+        loop.run_until_complete(handler.cost_aggregator.stop())
+        loop.close()
+
+
+if __name__ == "__main__":
+    main(
+        globals(),
+        {
+            "PRICE_TABLE_SIZE": ("--keys", "size of the synthetic price table"),
+            "TRANSCRIPT_SIZE": ("--messages", "size of the synthetic transcript"),
+        },
+        summary=lambda: print(f"price table: {PRICE_TABLE_SIZE} keys | transcript: {TRANSCRIPT_SIZE} messages"),
+    )
@@ -0,0 +1,122 @@
+"""
+Offline benchmarks for the request payload of the LiteLLM manifold pipeline (.data-pipelines/litellm_manifold_pipeline.py)
+
+Compares the former payload (a copy of the whole Open WebUI body, serialized by
+`requests` with the stdlib json) against `build_payload` + `dump_payload`.
+Open WebUI's `schemas` module is stubbed; the pipeline's own requirements
+(pydantic, requests, aiohttp) have to be installed.
+
+    pytest benchmarks/bench_manifold_payload.py --benchmark-only
+
+or, without pytest-benchmark installed:
+
+    python benchmarks/bench_manifold_payload.py [--messages 40] [--images 3]
+"""
+
+import base64
+import json
+import os
+import random
+import sys
+import types
+
+from runner import load_module, main
+
+HISTORY_SIZE = int(os.getenv("BENCH_HISTORY_SIZE", "40"))
+IMAGE_COUNT = int(os.getenv("BENCH_IMAGE_COUNT", "3"))
+
+
+def _load_pipeline():
+    schemas = types.ModuleType("schemas")
+    schemas.OpenAIChatMessage = type("OpenAIChatMessage", (), {})
+    sys.modules.setdefault("schemas", schemas)
+    return load_module("litellm_manifold_pipeline", ".data-pipelines", "litellm_manifold_pipeline.py")
+
+
+pipeline = _load_pipeline()
+
+
+def make_body(history: int = None, images: int = None, seed: int = 0) -> dict:
+    """A multimodal Open WebUI chat body as it reaches Pipeline.pipe"""
+    history = history or HISTORY_SIZE
+    images = IMAGE_COUNT if images is None else images
+    rnd = random.Random(seed)
+    image = "data:image/png;base64," + base64.b64encode(rnd.randbytes(384 * 1024)).decode()
+    text = "請幫我整理這份報告的重點，並列出後續的待辦事項。Please also summarize the key risks. " * 8
+
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for turn in range(history):
+        role = "user" if turn % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": text[: rnd.randint(100, len(text))]})
+    for _ in range(images):
+        messages.append({
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "這張圖片裡有什麼？"},
+                {"type": "image_url", "image_url": {"url": image}},
+            ],
+        })
+
+    user = {"id": "3f0c", "name": "benchmark", "email": "benchmark@example.com", "role": "user"}
+    return {
+        "stream": True,
+        "model": "claude-4.5-sonnet",
+        "messages": messages,
+        "temperature": 0.7,
+        "chat_id": "c4a1",
+        "title": False,
+        "user": user,
+        "files": [{"type": "image", "url": image}] * images,
+        "metadata": {"chat_id": "c4a1", "message_id": "m9", "session_id": "s1", "user_id": "3f0c", "files": []},
+        "custom_metadata": {"session_id": "c4a1", "trace_user_id": "benchmark / benchmark@example.com"},
+    }
+
+
+def legacy_payload(body: dict, model: str) -> bytes:
+    """The former payload: copy the body, pop Open WebUI keys, then `requests.post(json=...)`"""
+    payload = {**body, "model": model}
+    payload.pop("chat_id", None)
+    payload.pop("user", None)
+    payload.pop("title", None)
+    payload.pop("custom_metadata", None)
+    if body.get("custom_metadata"):
+        payload["metadata"] = body["custom_metadata"]
+    return json.dumps(payload, allow_nan=False).encode("utf-8")
+
+
+def lean_payload(body: dict, model: str) -> bytes:
+    return pipeline.dump_payload(pipeline.build_payload(body, model))
+
+
+def test_legacy_payload(benchmark):
+    body = make_body()
+    benchmark(legacy_payload, body, "openai/claude-4.5-sonnet")
+
+
+def test_lean_payload(benchmark):
+    body = make_body()
+    benchmark(lean_payload, body, "openai/claude-4.5-sonnet")
+
+
+def test_lean_payload_text_only(benchmark):
+    body = make_body(images=0)
+    benchmark(lean_payload, body, "openai/claude-4.5-sonnet")
+
+
+def print_payload_sizes():
+    body = make_body()
+    legacy_size = len(legacy_payload(body, "openai/claude-4.5-sonnet"))
+    lean_size = len(lean_payload(body, "openai/claude-4.5-sonnet"))
+    print(
+        f"history: {HISTORY_SIZE} messages | images: {IMAGE_COUNT} | orjson: {pipeline.orjson is not None}\n"
+        f"payload: legacy={legacy_size:,} bytes  lean={lean_size:,} bytes  "
+        f"saved={legacy_size - lean_size:,} bytes ({(legacy_size - lean_size) / legacy_size:.0%})"
+    )
+
+
+if __name__ == "__main__":
+    main(
+        globals(),
+        {"HISTORY_SIZE": ("--messages", "chat history length"), "IMAGE_COUNT": ("--images", "base64 images in the chat")},
+        summary=print_payload_sizes,
+    )
@@ -0,0 +1,165 @@
+"""
+Benchmarks of the two backends of the web scrape tool (workspace/tools/網頁擷取.py) on a saved HTML corpus
+
+Compares the local backend (BeautifulSoup readability-style extraction) with r.jina.ai,
+which is sent the same saved pages (POST with `html`), by latency and output size.
+Both outputs go through the tool's ContentCleaner. The Jina benchmark is skipped when
+r.jina.ai cannot be reached; set JINA_API_KEY for its higher rate limit.
+Needs the tool's requirements (aiohttp, pydantic, beautifulsoup4):
+
+    pytest benchmarks/bench_web_scrape_backends.py --benchmark-only
+
+or, without pytest-benchmark installed:
+
+    python benchmarks/bench_web_scrape_backends.py [--corpus DIR] [--pages 20]
+
+Without --corpus, synthetic news pages (navigation, sidebars, inline scripts, comments) are used;
+a corpus directory holds saved *.html pages.
+"""
+
+import asyncio
+import glob
+import os
+import random
+import statistics
+
+import aiohttp
+
+from runner import load_module, main, skip
+
+CORPUS_DIR = os.getenv("BENCH_CORPUS_DIR", "")
+PAGE_COUNT = int(os.getenv("BENCH_PAGE_COUNT", "20"))
+JINA_ROUNDS = int(os.getenv("BENCH_JINA_ROUNDS", "1"))
+JINA_URL = "https://r.jina.ai/"
+
+
+web_scrape = load_module("web_scrape_tool", "workspace", "tools", "網頁擷取.py")
+
+
+def make_page(index: int, rnd: random.Random) -> str:
+    """A news article wrapped in the usual boilerplate"""
+    sentence = [
+        "台積電公布第三季財報，營收年增 36%，優於市場預期。",
+        "Revenue rose on strong demand for AI accelerators, while smartphone chips stayed flat.",
+        "分析師指出，先進製程產能滿載，毛利率有望維持在 55% 以上。",
+        "The company raised its full-year guidance, citing a weaker currency and higher utilization.",
+    ]
+    links = "".join(f'<li><a href="/story/{rnd.randint(0, 10**6)}">Related story {n}, read more</a></li>' for n in range(40))
+    paragraphs = "".join(
+        f"<p>{' '.join(rnd.choice(sentence) for _ in range(rnd.randint(2, 6)))}</p>" for _ in range(rnd.randint(6, 30))
+    )
+    script = "var config = " + "{" + ",".join(f'"k{n}": {n}' for n in range(rnd.randint(500, 3000))) + "};"
+    return (
+        f"<!doctype html><html><head><title>Story {index} | Example News</title>"
+        f"<meta property='og:title' content='Story {index}'><style>body {{ margin: 0 }}</style><script>{script}</script></head>"
+        f"<body><header class='site-header'><nav><ul>{links[:2000]}</ul></nav></header>"
+        f"<div class='cookie-consent'>We use cookies to improve your experience, accept them all.</div>"
+        f"<div id='page'><aside class='sidebar'><ul>{links}</ul></aside>"
+        f"<article class='story-body'><h1>Story {index}</h1>{paragraphs}"
+        f"<figure><img src='/img/{index}.jpg' alt='Chart {index}'><figcaption>Quarterly revenue</figcaption></figure>"
+        f"<table><tr><th>Quarter</th><th>Revenue</th></tr><tr><td>Q2</td><td>{rnd.randint(500, 900)}</td></tr></table>"
+        f"</article><div class='comments'>{'<p>Great article, thanks, agreed.</p>' * 20}</div></div>"
+        f"<footer><ul>{links}</ul></footer></body></html>"
+    )
+
+
+def load_corpus(directory: str = None, pages: int = None, seed: int = 0) -> list:
+    """(url, html) pairs: the saved pages of `directory`, or synthetic ones"""
+    directory = CORPUS_DIR if directory is None else directory
+    pages = pages or PAGE_COUNT
+    if directory:
+        corpus = []
+        for path in sorted(glob.glob(os.path.join(directory, "*.html")))[:pages]:
+            with open(path, "r", encoding="utf-8", errors="replace") as file:
+                corpus.append((f"https://example.com/{os.path.basename(path)}", file.read()))
+        return corpus
+    rnd = random.Random(seed)
+    return [(f"https://example.com/news/{index}", make_page(index, rnd)) for index in range(pages)]
+
+
+def local_extract(url: str, html: str) -> str:
+    # The local backend is fed the raw response bytes
+    extractor = web_scrape.HtmlExtractor(url, charset="utf-8")
+    extractor.feed(html.encode("utf-8"))
+    return extractor.close()
+
+
+async def jina_extract(session: aiohttp.ClientSession, url: str, html: str) -> str:
+    headers = web_scrape._jina_headers(web_scrape.Tools.Valves(), {})
+    if os.getenv("JINA_API_KEY"):
+        headers["Authorization"] = f"Bearer {os.getenv('JINA_API_KEY')}"
+    async with session.post(JINA_URL, json={"url": url, "html": html}, headers=headers) as response:
+        response.raise_for_status()
+        cleaner = web_scrape.ContentCleaner()
+        cleaner.feed(await response.text())
+        return cleaner.close()
+
+
+_jina_reachable = None
+
+
+def jina_reachable() -> bool:
+    global _jina_reachable
+    if _jina_reachable is None:
+        async def probe():
+            timeout = aiohttp.ClientTimeout(total=10)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                await jina_extract(session, "https://example.com/", "<html><body><p>probe</p></body></html>")
+
+        try:
+            asyncio.run(probe())
+            _jina_reachable = True
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            _jina_reachable = False
+    return _jina_reachable
+
+
+def jina_corpus(corpus: list) -> list:
+    async def extract_all():
+        # Sequential, to stay within the keyless rate limit
+        timeout = aiohttp.ClientTimeout(total=60)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            return [await jina_extract(session, url, html) for url, html in corpus]
+
+    return asyncio.run(extract_all())
+
+
+def test_local_backend(benchmark):
+    corpus = load_corpus()
+    benchmark(lambda: [local_extract(url, html) for url, html in corpus])
+
+
+def test_jina_backend(benchmark):
+    if not jina_reachable():
+        skip(f"{JINA_URL} is not reachable")
+    corpus = load_corpus()
+    benchmark.pedantic(jina_corpus, args=(corpus,), rounds=JINA_ROUNDS)
+
+
+def print_output_sizes():
+    corpus = load_corpus()
+    html_size = sum(len(html.encode("utf-8")) for _, html in corpus)
+    local_size = sum(len(local_extract(url, html).encode("utf-8")) for url, html in corpus)
+    print(
+        f"corpus: {len(corpus)} pages ({CORPUS_DIR or 'synthetic'}) | html={html_size:,} bytes\n"
+        f"output: local={local_size:,} bytes (~{local_size // web_scrape.BYTES_PER_TOKEN:,} tokens)",
+        end="",
+    )
+    if jina_reachable():
+        jina_size = sum(len(content.encode("utf-8")) for content in jina_corpus(corpus))
+        print(f"  jina={jina_size:,} bytes (~{jina_size // web_scrape.BYTES_PER_TOKEN:,} tokens)")
+    else:
+        print(f"  jina=n/a ({JINA_URL} is not reachable)")
+
+
+if __name__ == "__main__":
+    main(
+        globals(),
+        {
+            "CORPUS_DIR": ("--corpus", "directory of saved *.html pages"),
+            "PAGE_COUNT": ("--pages", "pages used from the corpus"),
+            "JINA_ROUNDS": ("--jina-rounds", "passes over the corpus through r.jina.ai"),
+        },
+        summary=print_output_sizes,
+        throughput=lambda benchmark: f"{len(load_corpus()) / statistics.median(benchmark.timings):,.1f} pages/s",
+    )
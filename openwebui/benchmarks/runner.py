@@ -0,0 +1,133 @@
+"""
+Minimal stand-in for the pytest-benchmark fixture, used when the benchmarks are run as scripts,
+plus the module loader and standalone runner shared by the benchmark files
+
+A benchmark file only declares its sizes and hands its globals to `main`:
+
+    if __name__ == "__main__":
+        main(globals(), {"REQUEST_COUNT": ("--requests", "inlet calls per round")}, throughput=...)
+"""
+
+import argparse
+import importlib.util
+import os
+import statistics
+import sys
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+# openwebui/, which the paths of the benchmarked modules are relative to
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def load_module(name: str, *path: str):
+    """Import a file that is not on sys.path (pipelines, tools, the LiteLLM callbacks) as `name`"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, *path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Skipped(Exception):
+    """Raised by `skip` when a benchmark cannot run here, e.g. without network access"""
+
+
+def skip(reason: str):
+    """`pytest.skip` under pytest, `Skipped` for the standalone runners"""
+    if "pytest" in sys.modules:
+        import pytest
+
+        pytest.skip(reason)
+    raise Skipped(reason)
+
+
+class Benchmark:
+    """Subset of the pytest-benchmark fixture: `benchmark(fn, *args)` and `benchmark.pedantic(fn, rounds=...)`"""
+
+    def __init__(self, name: str, min_time: float = 0.5, max_rounds: int = 1000):
+        self.name = name
+        self.min_time = min_time
+        self.max_rounds = max_rounds
+        self.timings = []
+
+    def __call__(self, fn, *args, **kwargs):
+        result = fn(*args, **kwargs)  # warm-up
+        started = time.perf_counter()
+        while len(self.timings) < self.max_rounds and time.perf_counter() - started < self.min_time:
+            result = self._timed(fn, args, kwargs)
+        return result
+
+    def pedantic(self, fn, args=(), kwargs=None, setup=None, rounds=1, iterations=1):
+        result = None
+        for _ in range(rounds):
+            if setup is not None:
+                prepared = setup()
+                if prepared is not None:
+                    args, kwargs = prepared
+            for _ in range(iterations):
+                result = self._timed(fn, args, kwargs or {})
+        return result
+
+    def _timed(self, fn, args, kwargs):
+        started = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.timings.append(time.perf_counter() - started)
+        return result
+
+    def report(self) -> str:
+        timings_ms = [timing * 1000 for timing in self.timings]
+        return (
+            f"{self.name:<52} rounds={len(timings_ms):>5}  "
+            f"min={min(timings_ms):9.3f}ms  median={statistics.median(timings_ms):9.3f}ms  "
+            f"max={max(timings_ms):9.3f}ms"
+        )
+
+
+def argument_parser(doc: str) -> argparse.ArgumentParser:
+    """The standalone runner's options; benchmark files add their own before parsing"""
+    parser = argparse.ArgumentParser(description=doc, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="keyword", default="", help="only run benchmarks whose name contains this")
+    return parser
+
+
+def run_benchmarks(namespace: dict, keyword: str = "", throughput: Optional[Callable[[Benchmark], str]] = None):
+    """Run the `test_*` benchmarks of a benchmark module's globals and print their reports"""
+    for name, fn in list(namespace.items()):
+        if not (name.startswith("test_") and callable(fn) and keyword in name):
+            continue
+        benchmark = Benchmark(name[len("test_"):])
+        try:
+            fn(benchmark)
+        except Skipped as e:
+            print(f"{benchmark.name:<52} skipped: {e}")
+            continue
+        print(benchmark.report())
+        if throughput is not None:
+            print(f"{'':<52} {throughput(benchmark)}")
+
+
+def main(
+    namespace: dict,
+    options: Dict[str, Tuple[str, str]],
+    summary: Optional[Callable[[], None]] = None,
+    throughput: Optional[Callable[[Benchmark], str]] = None,
+):
+    """
+    Standalone runner of a benchmark module, called with its globals
+
+    `options` maps a module-level size (e.g. "PRICE_TABLE_SIZE", read from its
+    BENCH_* environment variable) to its command line flag and help. The
+    parsed values replace the module's sizes before `summary` prints the
+    run's header and the `test_*` benchmarks run.
+    """
+    parser = argument_parser(namespace["__doc__"])
+    for name, (flag, help_text) in options.items():
+        default = namespace[name]
+        parser.add_argument(flag, dest=name, type=type(default), default=default, help=help_text)
+    args = parser.parse_args()
+    for name in options:
+        namespace[name] = getattr(args, name)
+
+    if summary is not None:
+        summary()
+    run_benchmarks(namespace, args.keyword, throughput)
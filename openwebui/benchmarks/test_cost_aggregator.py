@@ -0,0 +1,65 @@
+"""
+Checks that CostAggregator prices and rolls up usage off the callback path, and dumps its windows
+
+    pytest benchmarks/test_cost_aggregator.py
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from bench_custom_callbacks import custom_callbacks
+
+PRICES = {"model-a": custom_callbacks.PricingRecord(input_cost_per_token=1e-6, output_cost_per_token=3e-6)}
+
+
+def pricing(model: str):
+    if model == "broken":
+        raise ValueError("bad price")
+    return PRICES.get(model)
+
+
+def test_totals_and_window_dump(tmp_path):
+    dump_path = tmp_path / "cost.jsonl"
+
+    async def run():
+        aggregator = custom_callbacks.CostAggregator(pricing, flush_interval=3600, dump_path=str(dump_path))
+        aggregator.record("model-a", "alice", ["team", "web"], 100, 10)
+        aggregator.record("model-a", None, ["team"], 200, None)
+        aggregator.record("unpriced", "alice", None, 50, 5)
+        aggregator.record("broken", "alice", None, 50, 5)
+        # Nothing is priced on the recording path itself
+        assert aggregator.snapshot()["model"] == {}
+        await aggregator.stop()
+        return aggregator
+
+    aggregator = asyncio.run(run())
+    totals = aggregator.snapshot()
+    assert set(totals["model"]) == {"model-a"}
+    assert totals["model"]["model-a"]["requests"] == 2
+    assert totals["model"]["model-a"]["prompt_tokens"] == 300
+    assert totals["model"]["model-a"]["completion_tokens"] == 10
+    assert totals["model"]["model-a"]["cost"] == pytest.approx(300e-6 + 30e-6)
+    assert totals["user"]["alice"]["requests"] == 1
+    assert totals["user"]["unknown"]["prompt_tokens"] == 200
+    assert (totals["tag"]["team"]["requests"], totals["tag"]["web"]["requests"]) == (2, 1)
+
+    # stop() flushed the open window as one JSON line
+    windows = [json.loads(line) for line in dump_path.read_text(encoding="utf-8").splitlines()]
+    assert len(windows) == 1
+    assert windows[0]["model"] == totals["model"]
+    assert windows[0]["dropped"] == 0
+
+
+def test_full_queue_drops_usage():
+    async def run():
+        aggregator = custom_callbacks.CostAggregator(pricing, flush_interval=3600, queue_size=2)
+        for _ in range(5):
+            aggregator.record("model-a", "alice", None, 1, 1)
+        await aggregator.stop()
+        return aggregator
+
+    aggregator = asyncio.run(run())
+    assert aggregator.dropped == 3
+    assert aggregator.snapshot()["model"]["model-a"]["requests"] == 2
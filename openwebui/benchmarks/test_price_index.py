@@ -0,0 +1,182 @@
+"""
+Checks that PriceTableIndex finds the same price table keys as the linear matching cascade it replaced
+
+    pytest benchmarks/test_price_index.py
+"""
+
+import re
+
+import pytest
+
+from bench_custom_callbacks import custom_callbacks, litellm, make_model_names, make_price_table
+
+
+def baseline_find_price_table_key(model: str, price_table: dict):
+    """The former `MyCustomHandler._find_price_table_key`: one scan of the price table per strategy"""
+    # Strategy 1: Exact match
+    if model in price_table:
+        return model
+
+    # Strategy 2: Try common provider prefixes
+    for prefix in custom_callbacks.COMMON_PROVIDER_PREFIXES:
+        candidate = f"{prefix}{model}"
+        if candidate in price_table:
+            return candidate
+
+    # Strategy 3: Normalized exact match
+    normalized_input = re.sub(r'[-_\.]', '', model.lower())
+    for key in price_table.keys():
+        if normalized_input == re.sub(r'[-_\.]', '', key.lower()):
+            return key
+
+    # Strategy 4: Component-based fuzzy match
+    model_components = re.findall(r'[a-z]+|\d+\.?\d*', model.lower())
+    best_match = None
+    best_ratio = 0
+    for key in price_table.keys():
+        key_components = re.findall(r'[a-z]+|\d+\.?\d*', key.lower())
+        matches = sum(1 for comp in model_components if comp in key_components)
+        match_ratio = matches / len(model_components) if model_components else 0
+        if match_ratio > best_ratio and match_ratio >= 0.7:
+            best_ratio = match_ratio
+            best_match = key
+    if best_match:
+        return best_match
+
+    # Strategy 5: Partial string match with high similarity
+    best_similarity = 0
+    best_match_key = None
+    for key in price_table.keys():
+        if model.lower() in key.lower() or key.lower() in model.lower():
+            similarity = min(len(model), len(key)) / max(len(model), len(key))
+            if similarity > best_similarity and similarity >= 0.6:
+                best_similarity = similarity
+                best_match_key = key
+    return best_match_key
+
+
+@pytest.fixture(scope="module", params=[300, 2000])
+def price_table(request):
+    return make_price_table(request.param, seed=request.param)
+
+
+def test_index_matches_baseline(price_table):
+    index = custom_callbacks.PriceTableIndex()
+    index.sync(price_table)
+    models = make_model_names(price_table, count=300) + ["", "gpt", "claude-4.5-sonnet", "unknown-model-x"]
+
+    for model in models:
+        match = index.find(model)
+        assert (match[0] if match else None) == baseline_find_price_table_key(model, price_table), model
+
+
+def test_incremental_sync_matches_rebuild(price_table):
+    index = custom_callbacks.PriceTableIndex(recheck_interval=0)
+    table = dict(price_table)
+    index.sync(table)
+    models = make_model_names(price_table, count=150)
+
+    # Keys removed, slotted in between surviving neighbours and appended, in place
+    keys = list(price_table)
+    for key in keys[::5]:
+        del table[key]
+    edited = {}
+    for position, key in enumerate(table):
+        edited[key] = table[key]
+        if position % 9 == 0:
+            edited[f"{key}-preview"] = table[key]
+    edited["gpt-4.5-turbo-20991231"] = price_table[keys[0]]
+    table.clear()
+    table.update(edited)
+    assert index.sync(table)
+    # Updated, not rebuilt: surviving keys keep their positions
+    assert index.positions[keys[1]] == custom_callbacks.PriceTableIndex.POSITION_GAP
+
+    rebuilt = custom_callbacks.PriceTableIndex()
+    rebuilt.sync(dict(table))
+    for model in models + keys[::5][:20] + ["gpt-4.5-turbo"]:
+        assert index.find(model) == rebuilt.find(model), model
+        match = index.find(model)
+        assert (match[0] if match else None) == baseline_find_price_table_key(model, table), model
+
+
+def test_handler_matches_baseline_after_update(price_table):
+    litellm.model_cost = dict(price_table)
+    handler = custom_callbacks.MyCustomHandler()
+    models = make_model_names(price_table, count=100)
+    for model in models:
+        handler._find_price_table_key(model)
+
+    # Entries are added and removed in place, as LiteLLM does when it reloads its cost map
+    removed = list(price_table)[::7]
+    for key in removed:
+        del litellm.model_cost[key]
+    litellm.model_cost["gpt-4.5-turbo-20991231"] = dict(price_table[next(iter(price_table))])
+    handler.price_index.recheck_interval = 0
+
+    for model in models + removed[:20]:
+        assert handler._find_price_table_key(model) == baseline_find_price_table_key(model, litellm.model_cost), model
+
+
+def test_mapping_cache_follows_price_table_reload(price_table):
+    litellm.model_cost = price_table
+    handler = custom_callbacks.MyCustomHandler()
+    model = next(model for model in make_model_names(price_table, count=300) if model not in price_table)
+    stale = handler._find_price_table_key(model)
+    assert handler._find_price_table_key(model) == stale
+
+    # LiteLLM's reload swaps in a new dict, noticed on the next lookup without waiting for a recheck
+    litellm.model_cost = {model: {"input_cost_per_token": 1e-6}, **price_table}
+    assert handler._find_price_table_key(model) == model
+    assert handler.model_mapping_cache_version == handler.price_index.version
+
+
+def test_unmatched_model_is_cached_until_the_table_changes(price_table, monkeypatch):
+    litellm.model_cost = dict(price_table)
+    handler = custom_callbacks.MyCustomHandler()
+    model = "zz-unlisted-qq"
+    finds = []
+    find = handler.price_index.find
+    monkeypatch.setattr(handler.price_index, "find", lambda name: finds.append(name) or find(name))
+
+    assert handler._find_price_table_key(model) is None
+    assert handler._find_price_table_key(model) is None
+    assert (finds, handler.negative_cache_hits) == ([model], 1)
+
+    # Adding a key changes the table size, which drops the negative entry right away
+    litellm.model_cost[model] = {"input_cost_per_token": 1e-6}
+    assert handler._find_price_table_key(model) == model
+    assert finds == [model, model]
+
+
+def test_pricing_follows_update_seen_by_mapping_first(price_table):
+    litellm.model_cost = dict(price_table)
+    handler = custom_callbacks.MyCustomHandler()
+    handler.price_index.recheck_interval = 0
+    models = make_model_names(price_table, count=50)
+    before = {model: handler._get_custom_pricing(model) for model in models}
+
+    # Reprice every entry; the mapping path sees the new table version before the pricing path does
+    for key, info in price_table.items():
+        litellm.model_cost[key] = {**info, "input_cost_per_token": (info.get("input_cost_per_token") or 0) * 2 + 1e-6}
+    litellm.model_cost["gpt-4.5-turbo-20991231"] = dict(price_table[next(iter(price_table))])
+    handler._find_price_table_key(models[0])
+
+    fresh = custom_callbacks.MyCustomHandler()
+    for model in models:
+        assert handler._get_custom_pricing(model) == fresh._get_custom_pricing(model), model
+    assert any(handler._get_custom_pricing(model) != before[model] for model in models)
+
+
+def test_pricing_follows_in_place_price_edit(price_table):
+    litellm.model_cost = {key: dict(info) for key, info in price_table.items()}
+    handler = custom_callbacks.MyCustomHandler()
+    handler.price_index.recheck_interval = 0
+    key = next(key for key, info in litellm.model_cost.items() if info.get("input_cost_per_token"))
+    handler._get_custom_pricing(key)
+
+    # register_model edits the entry of an existing key; DB-managed models replace its value
+    litellm.model_cost[key]["input_cost_per_token"] = 9e-6
+    assert handler._get_custom_pricing(key).input_cost_per_token == 9e-6 * handler.pricing_config.multiplier_for(key)
+    litellm.model_cost[key] = {**litellm.model_cost[key], "input_cost_per_token": 7e-6}
+    assert handler._get_custom_pricing(key).input_cost_per_token == 7e-6 * handler.pricing_config.multiplier_for(key)
@@ -0,0 +1,53 @@
+"""
+Checks how PricingConfig compiles the pricing file: entries, aliases and multipliers
+
+    pytest benchmarks/test_pricing_config.py
+"""
+
+import json
+
+import pytest
+
+from bench_custom_callbacks import custom_callbacks
+
+
+def load(tmp_path, config: dict):
+    path = tmp_path / "pricing.json"
+    path.write_text(json.dumps(config), encoding="utf-8")
+    return custom_callbacks.PricingConfig(str(path))
+
+
+def test_aliases_use_their_own_multiplier(tmp_path):
+    pricing = load(tmp_path, {
+        "multiplier": 1.5,
+        "multipliers": {"base": 2.0, "alias-exact": 3.0, "alias-pattern-*": 4.0},
+        "models": {
+            "base": {
+                "input_cost_per_token": 1.0,
+                "output_cost_per_token": 2.0,
+                "aliases": ["alias-exact", "alias-plain", "alias-pattern-*", "other-*"],
+            },
+        },
+    })
+
+    def costs(model: str):
+        record = pricing.lookup(model)
+        return record.input_cost_per_token, record.output_cost_per_token
+
+    assert costs("base") == (2.0, 4.0)
+    assert costs("alias-exact") == (3.0, 6.0)
+    assert costs("alias-plain") == (1.5, 3.0)
+    assert costs("alias-pattern-x") == (4.0, 8.0)
+    assert costs("other-x") == (1.5, 3.0)
+    for model in ("base", "alias-exact", "alias-plain", "alias-pattern-x", "other-x"):
+        assert pricing.lookup(model).input_cost_per_token == pytest.approx(pricing.multiplier_for(model))
+
+
+def test_alias_does_not_override_an_entry(tmp_path):
+    pricing = load(tmp_path, {
+        "models": {
+            "a": {"input_cost_per_token": 1.0, "aliases": ["b"]},
+            "b": {"input_cost_per_token": 5.0},
+        },
+    })
+    assert pricing.lookup("b").input_cost_per_token == 5.0
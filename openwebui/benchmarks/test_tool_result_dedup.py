@@ -0,0 +1,130 @@
+"""
+Checks the tool_result dedup of async_pre_call_hook against a naive reference, across edits and regenerations
+
+    pytest benchmarks/test_tool_result_dedup.py
+"""
+
+import asyncio
+import copy
+import random
+
+from bench_custom_callbacks import custom_callbacks, make_request, make_transcript
+
+
+def pre_call(handler, messages: list) -> list:
+    data = make_request(copy.deepcopy(messages))
+    return asyncio.run(
+        handler.async_pre_call_hook(custom_callbacks.UserAPIKeyAuth(), custom_callbacks.DualCache(), data, "completion")
+    )["messages"]
+
+
+def reference(messages: list) -> list:
+    """Keep the first tool_result of every tool_use_id; drop messages left without content blocks"""
+    seen = set()
+    cleaned = []
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            cleaned.append(message)
+            continue
+        kept = []
+        for block in content:
+            if isinstance(block, dict) and block.get("type") == "tool_result" and block.get("tool_use_id"):
+                if block["tool_use_id"] in seen:
+                    continue
+                seen.add(block["tool_use_id"])
+            kept.append(block)
+        if kept:
+            cleaned.append({**message, "content": kept})
+    return cleaned
+
+
+def blocks(messages: list) -> int:
+    return sum(len(message["content"]) for message in messages if isinstance(message["content"], list))
+
+
+def test_single_pass_copies_only_what_it_changes():
+    handler = custom_callbacks.MyCustomHandler()
+    clean = make_transcript(40, duplicate_ratio=0)
+    assert handler._deduplicate_tool_results(clean) == (clean, 0)
+    assert handler._deduplicate_tool_results(clean)[0] is clean
+
+    messages = make_transcript(40, duplicate_ratio=0.3)
+    original = copy.deepcopy(messages)
+    cleaned, removed = handler._deduplicate_tool_results(messages)
+    assert messages == original
+    assert cleaned == reference(messages)
+    assert removed and removed == blocks(messages) - blocks(cleaned)
+    # Messages without duplicates are passed through, not copied
+    for message in cleaned:
+        if message in messages:
+            assert any(message is kept for kept in messages)
+
+
+def test_edit_and_regenerate_within_one_session():
+    handler = custom_callbacks.MyCustomHandler()
+    messages = make_transcript(40, duplicate_ratio=0.3)
+    assert pre_call(handler, messages) == reference(messages)
+
+    # Edit a message in the middle: the first copy of a resent tool_result is compacted away,
+    # so its later copy is the one to keep now. Length and last message stay the same
+    resent = next(
+        message["content"][1]["tool_use_id"]
+        for message in messages if message["role"] == "user" and len(message["content"]) > 1
+    )
+    first = next(
+        index for index, message in enumerate(messages)
+        if message["role"] == "user" and message["content"][0]["tool_use_id"] == resent
+    )
+    edited = copy.deepcopy(messages)
+    edited[first]["content"] = [{"type": "text", "text": "compacted"}]
+    assert edited[-1] == messages[-1] and len(edited) == len(messages)
+    assert pre_call(handler, edited) == reference(edited)
+
+    # Regenerate the last turn: same length again, a different last message
+    regenerated = copy.deepcopy(edited)
+    regenerated[-1] = {
+        "role": "user",
+        "content": [{"type": "tool_result", "tool_use_id": "toolu_000001", "content": "rerun"}],
+    }
+    assert pre_call(handler, regenerated) == reference(regenerated)
+
+    # ...and continue the regenerated branch
+    continued = regenerated + make_transcript(6, duplicate_ratio=0)[1:]
+    assert pre_call(handler, continued) == reference(continued)
+
+
+def test_text_block_turned_into_tool_result():
+    handler = custom_callbacks.MyCustomHandler()
+    result = {"type": "tool_result", "tool_use_id": "t4", "content": "4"}
+    messages = [
+        {"role": "system", "content": "You are helpful"},
+        {"role": "assistant", "content": [{"type": "tool_use", "id": "t2", "name": "f", "input": {}}]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "t2", "content": "2"}]},
+        {"role": "user", "content": [{"type": "text", "text": "go on"}]},
+        {"role": "user", "content": [result, {"type": "tool_result", "tool_use_id": "t2", "content": "2"}]},
+    ]
+    assert pre_call(handler, messages) == reference(messages)
+
+    # Same length, same last message, a text block became a tool_result at the same position
+    edited = copy.deepcopy(messages)
+    edited[3]["content"] = [dict(result)]
+    assert pre_call(handler, edited) == reference(edited)
+
+
+def test_random_rewrites():
+    rnd = random.Random(7)
+    handler = custom_callbacks.MyCustomHandler()
+    messages = make_transcript(30, duplicate_ratio=0.3)
+    for _ in range(300):
+        messages = copy.deepcopy(messages)
+        index = rnd.randrange(1, len(messages))
+        tool_use_id = f"toolu_{rnd.randrange(12):06d}"
+        choice = rnd.random()
+        if choice < 0.4:
+            messages[index]["content"] = [{"type": "tool_result", "tool_use_id": tool_use_id, "content": "x"}]
+        elif choice < 0.7:
+            messages[index]["content"] = [{"type": "text", "text": "edited"}]
+        else:
+            messages.append({"role": "user", "content": [{"type": "tool_result", "tool_use_id": tool_use_id}]})
+        assert pre_call(handler, messages) == reference(messages)
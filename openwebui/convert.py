@@ -6,6 +6,19 @@ import re
 
 USER_ID = "29cdb3f9-ffa8-4978-9f0d-784a2796a858"
 
+# Python annotations -> JSON schema types of tool parameters
+JSON_TYPES = {
+    "str": "string",
+    "int": "integer",
+    "float": "number",
+    "bool": "boolean",
+    "dict": "object",
+    "list": "array",
+    "List": "array",
+    "tuple": "array",
+    "Tuple": "array",
+}
+
 class PythonScriptConverter:
     def __init__(self, directory='.'):
         self.base_directory = os.path.abspath(directory)
@@ -97,6 +110,8 @@ class PythonScriptConverter:
             "required": []
         }
         
+        annotations = {arg.arg: arg.annotation for arg in method.args.args}
+
         # Extract docstring and find parameters
         docstring = ast.get_docstring(method)
         param_pattern = re.compile(r":param (\w+): (.+)")
@@ -105,13 +120,31 @@ class PythonScriptConverter:
             for match in param_pattern.findall(docstring):
                 param_name, param_desc = match
                 params["properties"][param_name] = {
-                    "type": "str",  # Assuming all parameters are strings for simplicity
+                    **self.extract_type(annotations.get(param_name)),
                     "description": param_desc
                 }
                 params["required"].append(param_name)
 
         return params
 
+    def extract_type(self, annotation):
+        # JSON schema of a parameter from its annotation; unannotated parameters are assumed to be strings
+        if annotation is None:
+            return {"type": "string"}
+
+        items = None
+        if isinstance(annotation, ast.Subscript):
+            # list[str], List[int], Optional[str], ...
+            items = annotation.slice.elts[0] if isinstance(annotation.slice, ast.Tuple) else annotation.slice
+            annotation = annotation.value
+            if ast.unparse(annotation).split(".")[-1] == "Optional":
+                return self.extract_type(items)
+
+        json_type = JSON_TYPES.get(ast.unparse(annotation).split(".")[-1], "string")
+        if json_type == "array":
+            return {"type": "array", "items": self.extract_type(items)}
+        return {"type": json_type}
+
     def extract_manifest(self, tree, content):
         manifest = {}
         try:
@@ -1,113 +1,944 @@
 from litellm.integrations.custom_logger import CustomLogger
 import litellm
 from litellm.proxy.proxy_server import UserAPIKeyAuth, DualCache
-from typing import Optional, Literal, Dict
+from typing import Optional, Literal, Dict, Tuple, Callable, NamedTuple
 from litellm._logging import verbose_proxy_logger
+from collections import defaultdict, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import MappingProxyType
+import asyncio
+import bisect
+import fnmatch
+import json
 import os
 import re
+import threading
+import time
+
+# Provider prefixes tried (in order) when the model name is not a price table key itself
+COMMON_PROVIDER_PREFIXES = (
+    'openai/', 'anthropic/', 'gemini/', 'vertex_ai/', 'vertex_ai_beta/',
+    'bedrock/', 'azure/', 'azure_ai/', 'cohere/', 'replicate/',
+    'replicate/anthropic/', 'deepinfra/', 'deepinfra/anthropic/',
+    'heroku/', 'vercel_ai_gateway/', 'vercel_ai_gateway/anthropic/',
+    'groq/', 'together_ai/', 'perplexity/', 'mistral/', 'fireworks_ai/',
+    'anyscale/', 'databricks/', 'github_copilot/', 'openrouter/',
+    'xai/', 'cerebras/', 'nscale/', 'gmi/',
+)
+
+_MISSING = object()
+
+COMPONENT_MATCH_THRESHOLD = 0.7   # 70% component match threshold
+SIMILARITY_MATCH_THRESHOLD = 0.6
+
+_NORMALIZE_PATTERN = re.compile(r'[-_\.]')
+# Break model into components (e.g., "claude-4.5-sonnet" -> ["claude", "4.5", "sonnet"])
+_COMPONENT_PATTERN = re.compile(r'[a-z]+|\d+\.?\d*')
+
+
+def _normalize_model_name(model_name: str) -> str:
+    return _NORMALIZE_PATTERN.sub('', model_name.lower())
+
+
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _discard_posting(index: dict, token, pos: int):
+    positions = index.get(token)
+    if positions is not None:
+        positions.discard(pos)
+        if not positions:
+            del index[token]
+
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry once `maxsize` is reached"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        return key in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def items(self) -> list:
+        # Snapshot, so entries can be popped while iterating
+        return list(self.data.items())
+
+    def clear(self):
+        self.data.clear()
+
+
+class PriceTableIndex:
+    """
+    Precomputed lookup structures over litellm.model_cost
+
+    Every key gets a position following the price table's iteration order, so
+    ties are broken exactly like a linear scan would ("first key wins"):
+      - normalized: normalized key -> positions (strategy 3)
+      - components: component token -> positions, an inverted index (strategy 4)
+      - lowered_positions: lowercased key -> positions, for keys contained in the model (strategy 5)
+      - trigrams: 3-gram -> positions, for keys containing the model (strategy 5)
+      - by_length: lowercased key length -> positions, for models shorter than a 3-gram
+
+    Positions are spaced POSITION_GAP apart so keys added by a reload can be
+    slotted in between their neighbours without renumbering the whole table.
+    """
+
+    POSITION_GAP = 1 << 10
+
+    def __init__(self, recheck_interval: float = 60.0):
+        self.recheck_interval = recheck_interval
+        # Bumped whenever the price table is replaced or its keys change
+        self.version = 0
+        self.checked_at = 0.0
+        self._reset()
+
+    def _reset(self):
+        self.source = None
+        self.source_size = -1
+        self.positions = {}
+        self.keys = {}
+        self.lowered = {}
+        self.normalized = defaultdict(set)
+        self.components = defaultdict(set)
+        self.lowered_positions = defaultdict(set)
+        self.trigrams = defaultdict(set)
+        self.by_length = defaultdict(set)
+
+    def sync(self, price_table: dict) -> bool:
+        """
+        Bring the index up to date with `price_table`
+
+        Replacing the table (LiteLLM's scheduled reload) or changing its size is
+        noticed on every call; same-size in-place edits are picked up by a key
+        comparison at most every `recheck_interval` seconds.
+
+        Returns:
+            True if the price table changed and `version` was bumped
+        """
+        now = time.monotonic()
+        replaced = price_table is not self.source
+        if not replaced and len(price_table) == self.source_size and now - self.checked_at < self.recheck_interval:
+            return False
+        self.checked_at = now
+
+        changes = self._update(price_table)
+        if changes is None:
+            self._reset()
+            for pos, key in enumerate(price_table):
+                self._add(key, pos * self.POSITION_GAP)
+            verbose_proxy_logger.debug(f"[CustomPricing] Indexed {len(price_table)} price table keys")
+        elif changes != (0, 0):
+            verbose_proxy_logger.debug(
+                f"[CustomPricing] Price table index updated: +{changes[0]} / -{changes[1]} keys"
+            )
+        elif not replaced:
+            return False
+
+        self.source = price_table
+        self.source_size = len(price_table)
+        self.version += 1
+        return True
+
+    def _update(self, price_table: dict) -> Optional[Tuple[int, int]]:
+        """
+        Apply only the added and removed keys of `price_table` to the index
+
+        Returns:
+            (added, removed) counts, or None if surviving keys were reordered
+            and the index has to be rebuilt
+        """
+        if self.source is None:
+            return None
+
+        removed = set(self.positions)
+        runs = []       # (previous position, next position or None, added keys in between)
+        pending = []
+        last_pos = -1
+        for key in price_table:
+            pos = self.positions.get(key)
+            if pos is None:
+                pending.append(key)
+                continue
+            if pos <= last_pos:
+                return None
+            removed.discard(key)
+            if pending:
+                runs.append((last_pos, pos, pending))
+                pending = []
+            last_pos = pos
+        if pending:
+            runs.append((last_pos, None, pending))
+
+        for key in removed:
+            self._remove(key)
+
+        added = 0
+        for previous_pos, next_pos, keys in runs:
+            if next_pos is None:
+                step = self.POSITION_GAP
+            else:
+                step = (next_pos - previous_pos) // (len(keys) + 1)
+                if not step:
+                    return None
+            for offset, key in enumerate(keys, start=1):
+                self._add(key, previous_pos + step * offset)
+            added += len(keys)
+
+        return added, len(removed)
+
+    def _add(self, key: str, pos: int):
+        lowered = key.lower()
+        self.positions[key] = pos
+        self.keys[pos] = key
+        self.lowered[pos] = lowered
+
+        self.normalized[_normalize_model_name(key)].add(pos)
+        for component in set(_COMPONENT_PATTERN.findall(lowered)):
+            self.components[component].add(pos)
+        self.lowered_positions[lowered].add(pos)
+        for trigram in _trigrams(lowered):
+            self.trigrams[trigram].add(pos)
+        self.by_length[len(lowered)].add(pos)
+
+    def _remove(self, key: str):
+        pos = self.positions.pop(key)
+        del self.keys[pos]
+        lowered = self.lowered.pop(pos)
+
+        _discard_posting(self.normalized, _normalize_model_name(key), pos)
+        for component in set(_COMPONENT_PATTERN.findall(lowered)):
+            _discard_posting(self.components, component, pos)
+        _discard_posting(self.lowered_positions, lowered, pos)
+        for trigram in _trigrams(lowered):
+            _discard_posting(self.trigrams, trigram, pos)
+        _discard_posting(self.by_length, len(lowered), pos)
+
+    def find(self, model: str) -> Optional[Tuple[str, str, float]]:
+        """
+        Run the matching cascade of `MyCustomHandler._find_price_table_key`
+
+        Returns:
+            (matched_key, strategy, score) or None
+        """
+        price_table = self.source
+
+        # Strategy 1: Exact match
+        if model in price_table:
+            return model, "exact", 1.0
+
+        # Strategy 2: Try common provider prefixes
+        for prefix in COMMON_PROVIDER_PREFIXES:
+            candidate = f"{prefix}{model}"
+            if candidate in price_table:
+                return candidate, "prefix", 1.0
+
+        # Strategy 3: Normalized exact match
+        positions = self.normalized.get(_normalize_model_name(model))
+        if positions:
+            return self.keys[min(positions)], "normalized", 1.0
+
+        lowered_model = model.lower()
+
+        # Strategy 4: Component-based fuzzy match
+        match = self._find_by_components(lowered_model)
+        if match:
+            return match
+
+        # Strategy 5: Partial string match with high similarity
+        return self._find_by_similarity(model, lowered_model)
+
+    def _find_by_components(self, lowered_model: str) -> Optional[Tuple[str, str, float]]:
+        model_components = _COMPONENT_PATTERN.findall(lowered_model)
+        if not model_components:
+            return None
+
+        # Every occurrence of a component in the model counts, as in a linear scan
+        weights = defaultdict(int)
+        for component in model_components:
+            weights[component] += 1
+        postings = sorted(
+            ((self.components.get(component, set()), weight) for component, weight in weights.items()),
+            key=lambda item: len(item[0]),
+        )
+
+        # Prefix filtering: a key missing every one of the rarest components cannot
+        # reach the threshold anymore, so only keys holding one of them are scored
+        required = COMPONENT_MATCH_THRESHOLD * len(model_components)
+        remaining = len(model_components)
+        candidates = set()
+        for positions, weight in postings:
+            if remaining < required:
+                break
+            candidates.update(positions)
+            remaining -= weight
+
+        best_pos = None
+        best_ratio = 0
+        for pos in candidates:
+            count = sum(weight for positions, weight in postings if pos in positions)
+            match_ratio = count / len(model_components)
+            if match_ratio < COMPONENT_MATCH_THRESHOLD:
+                continue
+            if match_ratio > best_ratio or (match_ratio == best_ratio and pos < best_pos):
+                best_pos, best_ratio = pos, match_ratio
+
+        if best_pos is None:
+            return None
+        return self.keys[best_pos], "component", best_ratio
+
+    def _find_by_similarity(self, model: str, lowered_model: str) -> Optional[Tuple[str, str, float]]:
+        size = len(lowered_model)
+        if not size:
+            return None
+
+        # Keys contained in the model: look up every long enough substring of the model
+        candidates = set()
+        min_size = int(size * SIMILARITY_MATCH_THRESHOLD)
+        for length in range(max(min_size, 1), size + 1):
+            if length not in self.by_length:
+                continue
+            for start in range(size - length + 1):
+                positions = self.lowered_positions.get(lowered_model[start:start + length])
+                if positions:
+                    candidates.update(positions)
+
+        # Keys containing the model: intersect the posting lists of the model's 3-grams
+        max_size = int(size / SIMILARITY_MATCH_THRESHOLD) + 1
+        if size >= 3:
+            postings = sorted(
+                (self.trigrams.get(trigram, set()) for trigram in _trigrams(lowered_model)),
+                key=len,
+            )
+            containing = set(postings[0]).intersection(*postings[1:])
+        else:
+            containing = set()
+            for length in range(size, max_size + 1):
+                containing.update(self.by_length.get(length, ()))
+        candidates.update(
+            pos for pos in containing
+            if len(self.lowered[pos]) <= max_size and lowered_model in self.lowered[pos]
+        )
+
+        best_pos = None
+        best_similarity = 0
+        for pos in candidates:
+            key = self.keys[pos]
+            similarity = min(len(model), len(key)) / max(len(model), len(key))
+            if similarity < SIMILARITY_MATCH_THRESHOLD:
+                continue
+            if similarity > best_similarity or (similarity == best_similarity and pos < best_pos):
+                best_pos, best_similarity = pos, similarity
+
+        if best_pos is None:
+            return None
+        return self.keys[best_pos], "similarity", best_similarity
+
+COST_FIELDS = (
+    'input_cost_per_token',
+    'output_cost_per_token',
+    'input_cost_per_character',
+    'output_cost_per_character',
+    'input_cost_per_image',
+    'output_cost_per_image',
+    'input_cost_per_audio_token',
+    'output_cost_per_audio_token',
+    'output_cost_per_reasoning_token',
+    'cache_creation_input_token_cost',
+    'cache_read_input_token_cost',
+)
+
+
+def _cost_values(price_info: Optional[dict]) -> Optional[tuple]:
+    """Raw cost fields of a price table entry, compared to notice entries edited in place"""
+    if not price_info:
+        return None
+    return tuple(price_info.get(field) for field in COST_FIELDS)
+
+
+class PricingRecord(NamedTuple):
+    """Immutable per-unit costs of a model (USD); unset fields are None"""
+
+    input_cost_per_token: Optional[float] = None
+    output_cost_per_token: Optional[float] = None
+    input_cost_per_character: Optional[float] = None
+    output_cost_per_character: Optional[float] = None
+    input_cost_per_image: Optional[float] = None
+    output_cost_per_image: Optional[float] = None
+    input_cost_per_audio_token: Optional[float] = None
+    output_cost_per_audio_token: Optional[float] = None
+    output_cost_per_reasoning_token: Optional[float] = None
+    cache_creation_input_token_cost: Optional[float] = None
+    cache_read_input_token_cost: Optional[float] = None
+
+    @classmethod
+    def from_price_info(cls, price_info: dict) -> "PricingRecord":
+        """Pick the cost fields of a litellm.model_cost (or pricing file) entry"""
+        return cls(*(
+            float(price_info[field]) if price_info.get(field) is not None else None
+            for field in COST_FIELDS
+        ))
+
+    def scaled(self, multiplier: float) -> "PricingRecord":
+        if multiplier == 1.0:
+            return self
+        return PricingRecord(*(cost * multiplier if cost is not None else None for cost in self))
+
+
+class PricingConfig:
+    """
+    Custom pricing declared in a YAML (or JSON) pricing file, see pricing.yaml
+
+    The file is compiled into immutable lookup tables with the multipliers
+    already applied, so a lookup allocates nothing; only names matched by an
+    alias pattern are scaled at lookup time, by the multiplier of the requested
+    name like any other model. `refresh()` recompiles it
+    when its mtime changes (checked at most every `check_interval` seconds);
+    a file that fails to load keeps the previous tables in place.
+    """
+
+    GENERIC = {
+        "input_cost_per_token": 0.000001,   # $0.001 per 1K tokens
+        "output_cost_per_token": 0.000003,  # $0.003 per 1K tokens
+    }
+
+    def __init__(self, path: str, default_multiplier: float = 1.0, check_interval: float = 1.0):
+        self.path = path
+        self.default_multiplier = default_multiplier
+        self.check_interval = check_interval
+        self.mtime = None
+        self.checked_at = 0.0
+        self._compile({})
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """Reload the pricing file if it changed; returns True if new tables were compiled"""
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return False
+        self.checked_at = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            if self.mtime is None:
+                verbose_proxy_logger.warning(f"[CustomPricing] Pricing file not found: {self.path}")
+                self.mtime = -1
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+
+        try:
+            with open(self.path, encoding="utf-8") as pricing_file:
+                if self.path.endswith(".json"):
+                    config = json.load(pricing_file)
+                else:
+                    import yaml
+                    config = yaml.safe_load(pricing_file)
+            self._compile(config or {})
+        except Exception as e:
+            verbose_proxy_logger.error(f"[CustomPricing] ❌ Failed to load pricing file {self.path}: {e}")
+            return False
+
+        verbose_proxy_logger.info(
+            f"[CustomPricing] Loaded {len(self.models)} model price(s) from {self.path} | Multiplier: {self.multiplier}x"
+        )
+        return True
+
+    def _compile(self, config: dict):
+        multiplier = float(config.get("multiplier", self.default_multiplier))
+        multipliers = {}
+        multiplier_patterns = []
+        for name, value in (config.get("multipliers") or {}).items():
+            if _is_pattern(name):
+                multiplier_patterns.append((re.compile(fnmatch.translate(name)), float(value)))
+            else:
+                multipliers[name] = float(value)
+
+        models = {}
+        model_patterns = []
+        for name, entry in (config.get("models") or {}).items():
+            base = PricingRecord.from_price_info(entry)
+            models[name] = base.scaled(_match_multiplier(name, multipliers, multiplier_patterns, multiplier))
+            # An alias is billed with its own multiplier, not the one of the entry it shares prices with
+            for alias in entry.get("aliases") or ():
+                if _is_pattern(alias):
+                    model_patterns.append((re.compile(fnmatch.translate(alias)), base))
+                elif alias not in models:
+                    models[alias] = base.scaled(_match_multiplier(alias, multipliers, multiplier_patterns, multiplier))
+
+        # Swap the compiled tables in together
+        (
+            self.multiplier, self.multipliers, self.multiplier_patterns,
+            self.models, self.model_patterns, self.generic,
+        ) = (
+            multiplier, MappingProxyType(multipliers), tuple(multiplier_patterns),
+            MappingProxyType(models), tuple(model_patterns),
+            PricingRecord.from_price_info(config.get("generic") or self.GENERIC).scaled(multiplier),
+        )
+
+    def multiplier_for(self, model: str) -> float:
+        return _match_multiplier(model, self.multipliers, self.multiplier_patterns, self.multiplier)
+
+    def lookup(self, model: str) -> Optional[PricingRecord]:
+        """Pricing file entry of `model` or of an alias pattern matching it"""
+        record = self.models.get(model)
+        if record is not None:
+            return record
+        for pattern, record in self.model_patterns:
+            if pattern.match(model):
+                return record.scaled(self.multiplier_for(model))
+        return None
+
+
+def _is_pattern(name: str) -> bool:
+    return any(char in name for char in "*?[")
+
+
+def _match_multiplier(model: str, multipliers, multiplier_patterns, default: float) -> float:
+    # Exact name first, then the first matching pattern, then the file-wide multiplier
+    multiplier = multipliers.get(model)
+    if multiplier is not None:
+        return multiplier
+    for pattern, multiplier in multiplier_patterns:
+        if pattern.match(model):
+            return multiplier
+    return default
+
+
+class CostTotals:
+    """Request, token and cost counters of one model, user or tag"""
+
+    __slots__ = ("requests", "prompt_tokens", "completion_tokens", "input_cost", "output_cost")
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.input_cost = 0.0
+        self.output_cost = 0.0
+
+    def add(self, prompt_tokens: int, completion_tokens: int, input_cost: float, output_cost: float):
+        self.requests += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.input_cost += input_cost
+        self.output_cost += output_cost
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "input_cost": self.input_cost,
+            "output_cost": self.output_cost,
+            "cost": self.input_cost + self.output_cost,
+        }
+
+
+class CostAggregator:
+    """
+    Rolls up token usage and cost per model, user and tag in the background
+
+    `record()` is all the success callback pays for: it drops the usage into
+    a bounded asyncio queue. A worker task started on the first record prices
+    the queued usage in batches, and a second task closes the current window
+    every `flush_interval` seconds: its totals are appended as one JSON line to `dump_path`
+    (if set) and summarized in the debug log. `totals` keeps the running
+    totals since startup.
+    """
+
+    DIMENSIONS = ("model", "user", "tag")
+
+    def __init__(
+        self,
+        pricing: Callable[[str], Optional["PricingRecord"]],
+        flush_interval: float = 60.0,
+        dump_path: Optional[str] = None,
+        queue_size: int = 10000,
+    ):
+        self.pricing = pricing
+        self.flush_interval = flush_interval
+        self.dump_path = dump_path
+        self.queue_size = queue_size
+
+        self.queue = None
+        self.worker = None
+        self.flusher = None
+        # Usage dropped because the queue was full
+        self.dropped = 0
+        self.totals = self._empty_totals()
+        self.window = self._empty_totals()
+        self.window_started = time.time()
+
+    def _empty_totals(self) -> Dict[str, Dict[str, CostTotals]]:
+        return {dimension: defaultdict(CostTotals) for dimension in self.DIMENSIONS}
+
+    def record(self, model: str, user: Optional[str], tags: Optional[list], prompt_tokens: int, completion_tokens: int):
+        if self.worker is None or self.worker.done():
+            loop = asyncio.get_running_loop()
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self.worker = loop.create_task(self._consume())
+            self.flusher = loop.create_task(self._flush_periodically())
+
+        try:
+            self.queue.put_nowait((model, user, tags, prompt_tokens or 0, completion_tokens or 0))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _consume(self):
+        while True:
+            self._apply(*await self.queue.get())
+            while not self.queue.empty():
+                self._apply(*self.queue.get_nowait())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Close the current window and dump it"""
+        window = self._close_window()
+        if self.dump_path and window["model"]:
+            await asyncio.get_running_loop().run_in_executor(None, self._dump, window)
+
+    async def stop(self):
+        """Stop the background tasks and flush what was aggregated so far"""
+        for task in (self.worker, self.flusher):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self.worker = self.flusher = None
+
+        if self.queue is not None:
+            while not self.queue.empty():
+                self._apply(*self.queue.get_nowait())
+        await self.flush()
+
+    def _apply(self, model: str, user: Optional[str], tags: Optional[list], prompt_tokens: int, completion_tokens: int):
+        try:
+            pricing_info = self.pricing(model)
+        except Exception as e:
+            verbose_proxy_logger.error(f"[CustomPricing] ❌ Error calculating cost for {model}: {str(e)}")
+            return
+        if not pricing_info:
+            return
+
+        input_cost = prompt_tokens * (pricing_info.input_cost_per_token or 0)
+        output_cost = completion_tokens * (pricing_info.output_cost_per_token or 0)
+
+        for totals in (self.totals, self.window):
+            totals["model"][model].add(prompt_tokens, completion_tokens, input_cost, output_cost)
+            totals["user"][user or "unknown"].add(prompt_tokens, completion_tokens, input_cost, output_cost)
+            for tag in tags or ():
+                totals["tag"][tag].add(prompt_tokens, completion_tokens, input_cost, output_cost)
+
+    def _close_window(self) -> dict:
+        now = time.time()
+        window = {
+            "window_start": self.window_started,
+            "window_end": now,
+            "dropped": self.dropped,
+            **{
+                dimension: {name: totals.as_dict() for name, totals in by_name.items()}
+                for dimension, by_name in self.window.items()
+            },
+        }
+        self.window = self._empty_totals()
+        self.window_started = now
+
+        if window["model"]:
+            cost = sum(totals["cost"] for totals in window["model"].values())
+            requests = sum(totals["requests"] for totals in window["model"].values())
+            verbose_proxy_logger.debug(
+                f"[CustomPricing] 💰 {requests} request(s) | {len(window['model'])} model(s) | Cost: ${cost:.6f}"
+            )
+        return window
+
+    def _dump(self, window: dict):
+        try:
+            with open(self.dump_path, "a", encoding="utf-8") as dump_file:
+                dump_file.write(json.dumps(window, ensure_ascii=False) + "\n")
+        except OSError as e:
+            verbose_proxy_logger.warning(f"[CustomPricing] Failed to write cost dump {self.dump_path}: {e}")
+
+    def snapshot(self) -> dict:
+        """Running totals since startup, as plain dicts"""
+        return {
+            dimension: {name: totals.as_dict() for name, totals in by_name.items()}
+            for dimension, by_name in self.totals.items()
+        }
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_sample(name: str, labelnames: tuple, labelvalues: tuple, value: float) -> str:
+    if labelnames:
+        labels = ",".join(
+            f'{label}="{_escape_label_value(v)}"' for label, v in zip(labelnames, labelvalues, strict=True)
+        )
+        return f"{name}{{{labels}}} {value}"
+    return f"{name} {value}"
+
+
+class MetricCounter:
+    """Monotonic counter with optional labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = defaultdict(float)
+
+    def inc(self, *labelvalues, amount: float = 1):
+        self.values[labelvalues] += amount
+
+    def samples(self):
+        for labelvalues, value in list(self.values.items()):
+            yield _format_sample(self.name, self.labelnames, labelvalues, value)
+
+
+class MetricHistogram:
+    """Histogram with fixed upper bounds and optional labels"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tuple, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labelvalues -> [per-bucket counts (last one is +Inf), sum]
+        self.series = {}
+
+    def observe(self, value: float, *labelvalues):
+        series = self.series.get(labelvalues)
+        if series is None:
+            series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        labelnames = self.labelnames + ("le",)
+        for labelvalues, (counts, total) in list(self.series.items()):
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + ("+Inf",), counts, strict=True):
+                cumulative += count
+                yield _format_sample(f"{self.name}_bucket", labelnames, labelvalues + (upper_bound,), cumulative)
+            yield _format_sample(f"{self.name}_sum", self.labelnames, labelvalues, total)
+            yield _format_sample(f"{self.name}_count", self.labelnames, labelvalues, cumulative)
+
+
+class HandlerMetrics:
+    """
+    Prometheus metrics of MyCustomHandler
+
+    Updated from the proxy's event loop and rendered in the text exposition
+    format by `MetricsServer`, which runs in its own thread.
+    """
+
+    # Cost breakdowns exported as labels. Per-user totals stay in the cost dump: users are
+    # identified by "name / email", which must not leak through the unauthenticated endpoint
+    COST_DIMENSIONS = ("model", "tag")
+
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+    QUEUE_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, cost_aggregator: "CostAggregator"):
+        self.cost_aggregator = cost_aggregator
+        self.pre_call_hook_seconds = MetricHistogram(
+            "litellm_custom_pre_call_hook_seconds", "Time spent in async_pre_call_hook", self.LATENCY_BUCKETS
+        )
+        self.queue_latency_seconds = MetricHistogram(
+            "litellm_custom_queue_latency_seconds",
+            "Time from the Chat Info Filter inlet (request_start_time metadata) to async_pre_call_hook",
+            self.QUEUE_LATENCY_BUCKETS,
+        )
+        self.dedup_duplicates_removed = MetricCounter(
+            "litellm_custom_dedup_duplicates_removed_total", "Duplicate tool_result blocks removed"
+        )
+        self.dedup_messages_scanned = MetricCounter(
+            "litellm_custom_dedup_messages_scanned_total", "Messages scanned for duplicate tool_result blocks"
+        )
+        self.price_match = MetricCounter(
+            "litellm_custom_price_match_total", "Pricing lookups by the strategy that resolved them", ("strategy",)
+        )
+        self.mapping_cache = MetricCounter(
+            "litellm_custom_mapping_cache_requests_total",
+            "Price table mapping cache lookups by result (hit, negative_hit, miss)",
+            ("result",),
+        )
+        self.pricing_cache = MetricCounter(
+            "litellm_custom_pricing_cache_requests_total",
+            "Final pricing cache lookups by result (hit, miss)",
+            ("result",),
+        )
+
+    def render(self) -> str:
+        lines = []
+        for metric in (
+            self.pre_call_hook_seconds,
+            self.queue_latency_seconds,
+            self.dedup_duplicates_removed,
+            self.dedup_messages_scanned,
+            self.price_match,
+            self.mapping_cache,
+            self.pricing_cache,
+        ):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        lines.extend(self._render_costs())
+        return "\n".join(lines) + "\n"
+
+    def _render_costs(self):
+        totals = self.cost_aggregator.totals
+
+        yield "# HELP litellm_custom_tokens_total Tokens accounted by custom pricing"
+        yield "# TYPE litellm_custom_tokens_total counter"
+        for model, model_totals in list(totals["model"].items()):
+            yield _format_sample("litellm_custom_tokens_total", ("model", "type"), (model, "prompt"), model_totals.prompt_tokens)
+            yield _format_sample("litellm_custom_tokens_total", ("model", "type"), (model, "completion"), model_totals.completion_tokens)
+
+        for dimension in self.COST_DIMENSIONS:
+            name = "litellm_custom_cost_usd_total" if dimension == "model" else f"litellm_custom_{dimension}_cost_usd_total"
+            yield f"# HELP {name} Cost accounted by custom pricing per {dimension}, price multiplier included"
+            yield f"# TYPE {name} counter"
+            for value, dimension_totals in list(totals[dimension].items()):
+                yield _format_sample(name, (dimension,), (value,), dimension_totals.input_cost + dimension_totals.output_cost)
+
+        yield "# HELP litellm_custom_cost_queue_dropped_total Usage records dropped because the cost queue was full"
+        yield "# TYPE litellm_custom_cost_queue_dropped_total counter"
+        yield _format_sample("litellm_custom_cost_queue_dropped_total", (), (), self.cost_aggregator.dropped)
+
+
+class MetricsServer:
+    """
+    Serves `HandlerMetrics` on http://0.0.0.0:<port>/metrics from a daemon thread
+
+    The endpoint has no authentication: only expose it on the docker network Prometheus scrapes from.
+    The counters live in one process: with `--num_workers` above 1 only the worker that binds the
+    port first is exported, and the metrics of the other workers are lost.
+    """
+
+    def __init__(self, metrics: HandlerMetrics, port: int):
+        self.metrics = metrics
+        self.port = port
+        self.server = None
+
+    def start(self) -> bool:
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer(("0.0.0.0", self.port), Handler)
+        except OSError as e:
+            # e.g. another proxy worker process already serves the port; this worker's metrics are not exported
+            verbose_proxy_logger.warning(
+                f"[Metrics] Could not serve metrics on port {self.port}, this worker's metrics are not exported: {e}"
+            )
+            return False
+
+        threading.Thread(target=self.server.serve_forever, name="custom-callbacks-metrics", daemon=True).start()
+        verbose_proxy_logger.info(f"[Metrics] Serving custom callback metrics on :{self.port}/metrics")
+        return True
+
 
 # This file includes the custom callbacks for LiteLLM Proxy
 # Once defined, these can be passed in proxy_config.yaml
 class MyCustomHandler(CustomLogger): # https://docs.litellm.ai/docs/observability/custom_callback#callback-class
     # Class variables or attributes
     def __init__(self):
-        self.debug = True
+        self.debug = os.getenv("CUSTOM_CALLBACKS_DEBUG", "false").lower() == "true"
         self.custom_pricing_enabled = os.getenv("ENABLE_CUSTOM_PRICING", "true").lower() == "true"
         self.price_multiplier = float(os.getenv("PRICE_MULTIPLIER", "1.0"))
 
-        # Mapping cache: TrendMicro model name -> LiteLLM price table key
-        self.model_mapping_cache = {}
+        # Mapping cache: TrendMicro model name -> LiteLLM price table key (None if unmatched)
+        # Cleared whenever the price table index version differs from the one it was built against
+        self.model_mapping_cache = LRUCache(int(os.getenv("MODEL_MAPPING_CACHE_SIZE", "2048")))
+        self.model_mapping_cache_version = None
+        # Number of lookups answered by a cached "no match" entry
+        self.negative_cache_hits = 0
+
+        # Precomputed lookup structures over litellm.model_cost
+        self.price_index = PriceTableIndex(float(os.getenv("PRICE_TABLE_RECHECK_SECONDS", "60")))
 
-        # Fallback pricing for models not found in price table
-        self.fallback_pricing = self._load_fallback_pricing()
+        # Fallback pricing for models not found in price table, reloaded when the file changes
+        self.pricing_config = PricingConfig(
+            os.getenv("CUSTOM_PRICING_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pricing.yaml")),
+            self.price_multiplier,
+        )
+
+        # Pricing cache: model -> (final PricingRecord, strategy, price table key, raw costs of that key)
+        # Cleared whenever the price table keys or the pricing file change; entries whose price table
+        # entry was edited in place are dropped on the index's periodic recheck
+        self.pricing_cache = LRUCache(int(os.getenv("PRICING_CACHE_SIZE", "2048")))
+        self.pricing_cache_version = None
+        self.pricing_checked_at = time.monotonic()
+
+        # Token usage and cost totals, priced off the success callback path
+        self.cost_aggregator = CostAggregator(
+            self._get_custom_pricing,
+            flush_interval=float(os.getenv("COST_FLUSH_SECONDS", "60")),
+            dump_path=os.getenv("COST_DUMP_PATH") or None,
+            queue_size=int(os.getenv("COST_QUEUE_SIZE", "10000")),
+        )
+
+        # Prometheus metrics, served on CUSTOM_METRICS_PORT (0 disables the endpoint).
+        # Only one worker process can bind the port, see MetricsServer
+        self.metrics = HandlerMetrics(self.cost_aggregator)
+        metrics_port = int(os.getenv("CUSTOM_METRICS_PORT", "9464"))
+        if metrics_port:
+            MetricsServer(self.metrics, metrics_port).start()
 
         if self.custom_pricing_enabled:
             verbose_proxy_logger.info(
-                f"[CustomPricing] 🚀 Custom pricing enabled | Multiplier: {self.price_multiplier}x"
+                f"[CustomPricing] 🚀 Custom pricing enabled | Multiplier: {self.pricing_config.multiplier}x"
             )
         pass
 
-    def _load_fallback_pricing(self) -> Dict[str, Dict[str, float]]:
-        """
-        Load fallback pricing for models not found in LiteLLM price table
-
-        Priority:
-        1. From environment variables (CUSTOM_PRICING_<MODEL_NAME>)
-        2. From hardcoded defaults for known models
-        3. Generic fallback for unknown models
-        """
-        fallback = {}
-
-        # Check environment variables for custom pricing
-        # Format: CUSTOM_PRICING_CYBERTRON_0906="input:0.000001,output:0.000003"
-        for key, value in os.environ.items():
-            if key.startswith("CUSTOM_PRICING_"):
-                model_name = key.replace("CUSTOM_PRICING_", "").lower().replace("_", "-")
-                try:
-                    parts = value.split(",")
-                    input_cost = float(parts[0].split(":")[1])
-                    output_cost = float(parts[1].split(":")[1])
-                    fallback[model_name] = {
-                        "input_cost_per_token": input_cost,
-                        "output_cost_per_token": output_cost,
-                    }
-                    verbose_proxy_logger.info(
-                        f"[CustomPricing] Loaded custom pricing from env for {model_name}"
-                    )
-                except Exception as e:
-                    verbose_proxy_logger.warning(
-                        f"[CustomPricing] Failed to parse custom pricing for {key}: {e}"
-                    )
-
-        # Hardcoded fallback for known models without price table entries
-        hardcoded = {
-            # Nvidia Nemotron models (estimate based on similar 30B models)
-            "nvidia-nemotron-3-nano-30b-gmi": {
-                "input_cost_per_token": 0.0000003,   # Similar to Llama 30B
-                "output_cost_per_token": 0.0000006,
-            },
-            "nvidia-nemotron-nano-3-30b-aws": {
-                "input_cost_per_token": 0.0000003,
-                "output_cost_per_token": 0.0000006,
-            },
-            # Stable Diffusion 3.5 Large (estimate based on SD 3.0)
-            "stable-diffusion-3.5-large": {
-                "input_cost_per_token": 0.000004,
-                "output_cost_per_token": 0.000012,
-            },
-            # Unknown models - conservative pricing
-            "cybertron-0906": {
-                "input_cost_per_token": 0.000002,
-                "output_cost_per_token": 0.000008,
-            },
-            "gpt-c35s": {
-                "input_cost_per_token": 0.0000005,  # Similar to GPT-3.5
-                "output_cost_per_token": 0.000002,
-            },
-            "primus-christmas": {
-                "input_cost_per_token": 0.000002,
-                "output_cost_per_token": 0.000008,
-            },
-            "primus-labor-70b": {
-                "input_cost_per_token": 0.000001,   # 70B model
-                "output_cost_per_token": 0.000003,
-            },
-            # Special deployment versions - map to base model pricing
-            "qwen3-vl-4b-it-gmi-ray": {
-                "input_cost_per_token": 0.0000001,  # Small model
-                "output_cost_per_token": 0.0000003,
-            },
-            "smollm3-3b-gmi-ray": {
-                "input_cost_per_token": 0.0000001,  # Small model
-                "output_cost_per_token": 0.0000003,
-            },
-        }
-
-        # Merge: env vars override hardcoded values
-        hardcoded.update(fallback)
-
-        return hardcoded
-
     def _normalize_model_name(self, model_name: str) -> str:
         """
         Normalize model name for comparison
@@ -116,245 +947,220 @@ class MyCustomHandler(CustomLogger): # https://docs.litellm.ai/docs/observabilit
           - "claude-3-5-sonnet" -> "claude35sonnet"
           - "gpt-4o" -> "gpt4o"
         """
-        normalized = model_name.lower()
-        normalized = re.sub(r'[-_\.]', '', normalized)
-        return normalized
+        return _normalize_model_name(model_name)
 
     def _find_price_table_key(self, model: str) -> Optional[str]:
         """
         Find the best matching key in litellm.model_cost for the given model
 
+        Returns:
+            matched_key or None
+        """
+        match = self._match_price_table(model)
+        return match[0] if match else None
+
+    def _match_price_table(self, model: str) -> Optional[Tuple[str, str]]:
+        """
+        Find the best matching key in litellm.model_cost and the strategy that found it
+
         Matching strategies (in order):
         1. Exact match
         2. Prefix match (with provider name)
         3. Normalized exact match
         4. Component-based fuzzy match
-        5. Version-aware match (find latest version)
+        5. Partial string match with high similarity
+
+        The strategies are answered by `PriceTableIndex`, which follows
+        litellm.model_cost across reloads, so a cache miss no longer scans the
+        whole price table. Unmatched models are cached as negative entries,
+        and all cached mappings are dropped whenever the price table changes.
 
         Returns:
-            matched_key or None
+            (matched_key, strategy) or None
         """
-        # Check cache first
-        if model in self.model_mapping_cache:
-            return self.model_mapping_cache[model]
-
-        price_table = litellm.model_cost
-
-        # Strategy 1: Exact match
-        if model in price_table:
-            self.model_mapping_cache[model] = model
+        self.price_index.sync(litellm.model_cost)
+        if self.model_mapping_cache_version != self.price_index.version:
+            self.model_mapping_cache.clear()
+            self.model_mapping_cache_version = self.price_index.version
+
+        # Check cache first; a cached None is a negative entry that lives until the price table changes
+        cached = self.model_mapping_cache.get(model, _MISSING)
+        if cached is None:
+            self.negative_cache_hits += 1
+            self.metrics.mapping_cache.inc("negative_hit")
+            return None
+        if cached is not _MISSING:
+            self.metrics.mapping_cache.inc("hit")
+            return cached
+        self.metrics.mapping_cache.inc("miss")
+
+        match = self.price_index.find(model)
+
+        if match is None:
+            self.model_mapping_cache.set(model, None)
             if self.debug:
-                verbose_proxy_logger.debug(f"[CustomPricing] ✓ Exact match: {model}")
-            return model
-
-        # Strategy 2: Try common provider prefixes
-        common_prefixes = [
-            'openai/', 'anthropic/', 'gemini/', 'vertex_ai/', 'vertex_ai_beta/',
-            'bedrock/', 'azure/', 'azure_ai/', 'cohere/', 'replicate/',
-            'replicate/anthropic/', 'deepinfra/', 'deepinfra/anthropic/',
-            'heroku/', 'vercel_ai_gateway/', 'vercel_ai_gateway/anthropic/',
-            'groq/', 'together_ai/', 'perplexity/', 'mistral/', 'fireworks_ai/',
-            'anyscale/', 'databricks/', 'github_copilot/', 'openrouter/',
-            'xai/', 'cerebras/', 'nscale/', 'gmi/',
-        ]
-
-        for prefix in common_prefixes:
-            candidate = f"{prefix}{model}"
-            if candidate in price_table:
-                self.model_mapping_cache[model] = candidate
-                if self.debug:
-                    verbose_proxy_logger.debug(f"[CustomPricing] ✓ Prefix match: {model} -> {candidate}")
-                return candidate
-
-        # Strategy 3: Normalized exact match
-        normalized_input = self._normalize_model_name(model)
-        for key in price_table.keys():
-            normalized_key = self._normalize_model_name(key)
-            if normalized_input == normalized_key:
-                self.model_mapping_cache[model] = key
-                if self.debug:
-                    verbose_proxy_logger.debug(f"[CustomPricing] ✓ Normalized match: {model} -> {key}")
-                return key
-
-        # Strategy 4: Component-based fuzzy match
-        # Break model into components (e.g., "claude-4.5-sonnet" -> ["claude", "4", "5", "sonnet"])
-        model_components = re.findall(r'[a-z]+|\d+\.?\d*', model.lower())
-
-        best_match = None
-        best_ratio = 0
-
-        for key in price_table.keys():
-            key_components = re.findall(r'[a-z]+|\d+\.?\d*', key.lower())
+                verbose_proxy_logger.debug(f"[CustomPricing] ✗ No price table match for: {model}")
+            return None
 
-            # Count matching components
-            matches = sum(1 for comp in model_components if comp in key_components)
-            match_ratio = matches / len(model_components) if model_components else 0
+        matched_key, strategy, score = match
+        self.model_mapping_cache.set(model, (matched_key, strategy))
 
-            if match_ratio > best_ratio and match_ratio >= 0.7:  # 70% component match threshold
-                best_ratio = match_ratio
-                # Extract date if exists for version sorting
-                date_match = re.search(r'(\d{8})', key)
-                date_val = int(date_match.group(1)) if date_match else 0
-                best_match = (key, date_val, match_ratio)
-
-        if best_match and best_ratio >= 0.7:
-            matched_key = best_match[0]
-            self.model_mapping_cache[model] = matched_key
-            if self.debug:
+        if self.debug:
+            if strategy == "exact":
+                verbose_proxy_logger.debug(f"[CustomPricing] ✓ Exact match: {model}")
+            elif strategy == "prefix":
+                verbose_proxy_logger.debug(f"[CustomPricing] ✓ Prefix match: {model} -> {matched_key}")
+            elif strategy == "normalized":
+                verbose_proxy_logger.debug(f"[CustomPricing] ✓ Normalized match: {model} -> {matched_key}")
+            elif strategy == "component":
                 verbose_proxy_logger.debug(
-                    f"[CustomPricing] ≈ Component match: {model} -> {matched_key} ({best_ratio*100:.0f}%)"
+                    f"[CustomPricing] ≈ Component match: {model} -> {matched_key} ({score*100:.0f}%)"
                 )
-            return matched_key
-
-        # Strategy 5: Partial string match with high similarity
-        best_similarity = 0
-        best_match_key = None
-
-        for key in price_table.keys():
-            # Check if model name is substring of key or vice versa
-            if model.lower() in key.lower() or key.lower() in model.lower():
-                similarity = min(len(model), len(key)) / max(len(model), len(key))
-                if similarity > best_similarity and similarity >= 0.6:
-                    best_similarity = similarity
-                    best_match_key = key
-
-        if best_match_key:
-            self.model_mapping_cache[model] = best_match_key
-            if self.debug:
+            else:
                 verbose_proxy_logger.debug(
-                    f"[CustomPricing] ≈ Similarity match: {model} -> {best_match_key} ({best_similarity*100:.0f}%)"
+                    f"[CustomPricing] ≈ Similarity match: {model} -> {matched_key} ({score*100:.0f}%)"
                 )
-            return best_match_key
+        return matched_key, strategy
 
-        # No match found
-        if self.debug:
-            verbose_proxy_logger.debug(f"[CustomPricing] ✗ No price table match for: {model}")
-        return None
-
-    def _get_custom_pricing(self, model: str) -> Optional[Dict[str, float]]:
+    def _get_custom_pricing(self, model: str) -> Optional[PricingRecord]:
         """
         Get custom pricing for a model
 
         Priority:
         1. From litellm.model_cost (updated by LiteLLM's scheduled reload)
-        2. From fallback_pricing (hardcoded or env vars)
-        3. Generic fallback
+        2. From the pricing file models (or their aliases)
+        3. Generic fallback from the pricing file
+
+        Results are cached per model until the price table or the pricing
+        file changes, so repeated models cost a single cache lookup.
 
         Returns:
-            Dict with 'input_cost_per_token' and 'output_cost_per_token'
+            PricingRecord with the multiplier already applied
+        """
+        # Either path may see the price table change first (sync() reports it only once),
+        # so each cache remembers the index version it was built against
+        self.price_index.sync(litellm.model_cost)
+        if self.pricing_config.refresh() or self.pricing_cache_version != self.price_index.version:
+            self.pricing_cache.clear()
+            self.pricing_cache_version = self.price_index.version
+        now = time.monotonic()
+        if now - self.pricing_checked_at >= self.price_index.recheck_interval:
+            self.pricing_checked_at = now
+            self._revalidate_pricing_cache()
+
+        # Resolved pricing is immutable, so a cached record is handed out as is
+        cached = self.pricing_cache.get(model)
+        if cached is not None:
+            pricing, strategy = cached[:2]
+            self.metrics.price_match.inc(strategy)
+            self.metrics.pricing_cache.inc("hit")
+            return pricing
+        self.metrics.pricing_cache.inc("miss")
+
+        pricing, strategy, price_key = self._resolve_custom_pricing(model)
+        source = _cost_values(litellm.model_cost.get(price_key)) if price_key else None
+        self.pricing_cache.set(model, (pricing, strategy, price_key, source))
+        self.metrics.price_match.inc(strategy)
+        return pricing
+
+    def _revalidate_pricing_cache(self):
+        """
+        Drop cached pricing whose price table entry changed without a key change
+
+        `register_model` and DB-managed models (STORE_MODEL_IN_DB) edit or
+        replace the value of an existing key, which the key-based index
+        version does not see.
         """
+        stale = 0
+        for model, (_, _, price_key, source) in self.pricing_cache.items():
+            if price_key is not None and _cost_values(litellm.model_cost.get(price_key)) != source:
+                self.pricing_cache.pop(model)
+                stale += 1
+        if stale and self.debug:
+            verbose_proxy_logger.info(f"[CustomPricing] Repricing {stale} models after price table edits")
+
+    def _resolve_custom_pricing(self, model: str) -> Tuple[PricingRecord, str, Optional[str]]:
+        """Build the final pricing of `model`, name the strategy that resolved it and the price table key used"""
         # Priority 1: Try to find in litellm.model_cost via mapping
-        price_key = self._find_price_table_key(model)
-        if price_key:
+        match = self._match_price_table(model)
+        if match:
+            price_key, strategy = match
             price_info = litellm.model_cost.get(price_key)
             if price_info:
-                # Extract relevant pricing fields
-                pricing = {
-                    "input_cost_per_token": price_info.get("input_cost_per_token", 0),
-                    "output_cost_per_token": price_info.get("output_cost_per_token", 0),
-                }
-
-                # Apply multiplier if configured
-                if self.price_multiplier != 1.0:
-                    pricing = self._apply_multiplier(pricing)
-
-                return pricing
+                # Extract relevant pricing fields and apply the multiplier
+                pricing = PricingRecord.from_price_info(price_info).scaled(self.pricing_config.multiplier_for(model))
+                return pricing, strategy, price_key
 
         # Priority 2: Try fallback pricing
-        if model in self.fallback_pricing:
-            pricing = self.fallback_pricing[model].copy()
-
+        pricing = self.pricing_config.lookup(model)
+        if pricing is not None:
             if self.debug:
                 verbose_proxy_logger.info(
                     f"[CustomPricing] 💡 Using fallback pricing for: {model}"
                 )
 
-            # Apply multiplier
-            if self.price_multiplier != 1.0:
-                pricing = self._apply_multiplier(pricing)
-
-            return pricing
+            return pricing, "fallback", None
 
         # Priority 3: Generic fallback
         verbose_proxy_logger.warning(
             f"[CustomPricing] ⚠️  Using generic fallback pricing for: {model}"
         )
 
-        generic_pricing = {
-            "input_cost_per_token": 0.000001,   # $0.001 per 1K tokens
-            "output_cost_per_token": 0.000003,  # $0.003 per 1K tokens
-        }
-
-        if self.price_multiplier != 1.0:
-            generic_pricing = self._apply_multiplier(generic_pricing)
-
-        return generic_pricing
-
-    def _apply_multiplier(self, pricing: Dict[str, float]) -> Dict[str, float]:
-        """Apply price multiplier to pricing information"""
-        result = {}
-
-        cost_fields = [
-            'input_cost_per_token',
-            'output_cost_per_token',
-            'input_cost_per_character',
-            'output_cost_per_character',
-            'input_cost_per_image',
-            'output_cost_per_image',
-            'input_cost_per_audio_token',
-            'output_cost_per_audio_token',
-            'output_cost_per_reasoning_token',
-            'cache_creation_input_token_cost',
-            'cache_read_input_token_cost',
-        ]
-
-        for field in cost_fields:
-            if field in pricing and pricing[field] is not None:
-                result[field] = float(pricing[field]) * self.price_multiplier
-            elif field in pricing:
-                result[field] = pricing[field]
-
-        return result
+        return self.pricing_config.generic, "generic", None
 
     def _deduplicate_tool_results(self, messages: list) -> tuple[list, int]:
-        """Remove duplicate tool_result blocks with same tool_use_id across ALL messages"""
+        """
+        Remove duplicate tool_result blocks with same tool_use_id across ALL messages
+
+        Single pass over the messages. The input messages are never modified:
+        if there are no duplicates the same list is returned as is, otherwise
+        only the messages holding duplicates are replaced by shallow copies.
+        """
         if not messages:
             return messages, 0
 
-        cleaned_messages = []
-        duplicates_removed = 0
-        # Global tool_result_map to track tool_use_ids across ALL messages
-        global_tool_result_map = {}
+        # tool_use_id -> (message index, block index) of the tool_result to keep
+        first_seen = {}
+        # Ascending indices of messages holding duplicate tool_results
+        dirty = []
 
-        for msg in messages:
-            if not isinstance(msg.get('content'), list):
-                cleaned_messages.append(msg)
+        for index, msg in enumerate(messages):
+            content = msg.get('content')
+            if not isinstance(content, list):
                 continue
 
-            has_tool_results = any(
-                isinstance(block, dict) and block.get('type') == 'tool_result'
-                for block in msg.get('content', [])
-            )
+            for block_index, block in enumerate(content):
+                if not isinstance(block, dict) or block.get('type') != 'tool_result':
+                    continue
+                tool_use_id = block.get('tool_use_id')
+                if not tool_use_id:
+                    continue
+
+                if tool_use_id not in first_seen:
+                    # First time seeing this tool_use_id across all messages
+                    first_seen[tool_use_id] = (index, block_index)
+                elif not dirty or dirty[-1] != index:
+                    dirty.append(index)
+
+        if not dirty:
+            return messages, 0
+
+        cleaned_messages = messages[:dirty[0]]
+        duplicates_removed = 0
+        first_dirty = dirty[0]
+        dirty = set(dirty)
 
-            if not has_tool_results:
+        for index in range(first_dirty, len(messages)):
+            msg = messages[index]
+            if index not in dirty:
                 cleaned_messages.append(msg)
                 continue
 
             cleaned_content = []
-
-            for block in msg['content']:
-                if not isinstance(block, dict):
-                    cleaned_content.append(block)
-                    continue
-
-                if block.get('type') == 'tool_result':
+            for block_index, block in enumerate(msg['content']):
+                if isinstance(block, dict) and block.get('type') == 'tool_result':
                     tool_use_id = block.get('tool_use_id')
-
-                    if not tool_use_id:
-                        cleaned_content.append(block)
-                        continue
-
-                    if tool_use_id in global_tool_result_map:
+                    if tool_use_id and first_seen[tool_use_id] != (index, block_index):
                         # This is a duplicate - skip it entirely
                         duplicates_removed += 1
 
@@ -362,15 +1168,7 @@ class MyCustomHandler(CustomLogger): # https://docs.litellm.ai/docs/observabilit
                             verbose_proxy_logger.warning(f"[ToolResultDedup] ⚠️  Found duplicate tool_result: {tool_use_id}")
                             verbose_proxy_logger.warning(f"[ToolResultDedup] 🚫 Skipping duplicate (already exists in previous message)")
                         continue
-                    else:
-                        # First time seeing this tool_use_id across all messages
-                        global_tool_result_map[tool_use_id] = block
-                        cleaned_content.append(block)
-
-                        if self.debug:
-                            verbose_proxy_logger.debug(f"[ToolResultDedup] ✓ Added tool_result: {tool_use_id}")
-                else:
-                    cleaned_content.append(block)
+                cleaned_content.append(block)
 
             if cleaned_content:
                 msg_copy = msg.copy()
@@ -389,15 +1187,29 @@ class MyCustomHandler(CustomLogger): # https://docs.litellm.ai/docs/observabilit
             "moderation",
             "audio_transcription",
         ]):
+        started = time.perf_counter()
+        try:
+            return self._pre_call(data)
+        finally:
+            self.metrics.pre_call_hook_seconds.observe(time.perf_counter() - started)
+
+    def _pre_call(self, data: dict) -> dict:
+        # Stamped by the Chat Info Filter; wall clock, since it was taken in another container
+        request_start_time = data["metadata"].get("request_start_time")
+        if isinstance(request_start_time, (int, float)):
+            self.metrics.queue_latency_seconds.observe(max(time.time() - request_start_time, 0.0))
+
         tags_set = set(data["metadata"].get("tags", []))
         tags_set.add(data["proxy_server_request"]["headers"]["host"])
         data["metadata"]["tags"] = list(tags_set)
 
         # Deduplicate tool_result blocks to prevent API 400 errors
-        if "messages" in data:
+        if data.get("messages"):
             original_count = len(data["messages"])
+            self.metrics.dedup_messages_scanned.inc(amount=original_count)
             cleaned_messages, duplicates_removed = self._deduplicate_tool_results(data["messages"])
             data["messages"] = cleaned_messages
+            self.metrics.dedup_duplicates_removed.inc(amount=duplicates_removed)
 
             if self.debug and duplicates_removed > 0:
                 verbose_proxy_logger.warning(f"[ToolResultDedup] Messages: {original_count} → {len(cleaned_messages)}")
@@ -415,11 +1227,12 @@ class MyCustomHandler(CustomLogger): # https://docs.litellm.ai/docs/observabilit
 
     async def async_log_success_event(self, kwargs, response_obj, start_time, end_time):
         """
-        Override success event to calculate and log custom pricing
+        Override success event to account custom pricing
 
-        This hook is called AFTER the API call succeeds.
-        We read from litellm.model_cost which has been automatically updated
-        by LiteLLM's scheduled reload mechanism (configured via Admin UI).
+        This hook is called AFTER the API call succeeds. It only hands the
+        token usage to `cost_aggregator`, which prices it in the background
+        with litellm.model_cost (kept up to date by LiteLLM's scheduled reload
+        mechanism, configured via Admin UI) and rolls up the totals.
         """
         try:
             if not self.custom_pricing_enabled:
@@ -429,44 +1242,23 @@ class MyCustomHandler(CustomLogger): # https://docs.litellm.ai/docs/observabilit
             if not model:
                 return
 
-            # Get custom pricing (from litellm.model_cost or fallback)
-            pricing_info = self._get_custom_pricing(model)
-            if not pricing_info:
-                return
-
-            # Calculate custom cost
             usage = response_obj.get("usage", {})
             if not usage:
                 return
 
-            prompt_tokens = usage.get("prompt_tokens", 0)
-            completion_tokens = usage.get("completion_tokens", 0)
+            metadata = kwargs.get("litellm_params", {}).get("metadata") or {}
+            user = metadata.get("trace_user_id") or metadata.get("user_api_key_user_id") or kwargs.get("user")
 
-            input_cost_per_token = pricing_info.get("input_cost_per_token", 0)
-            output_cost_per_token = pricing_info.get("output_cost_per_token", 0)
-
-            input_cost = prompt_tokens * input_cost_per_token
-            output_cost = completion_tokens * output_cost_per_token
-            total_cost = input_cost + output_cost
-
-            if self.debug:
-                verbose_proxy_logger.info(
-                    f"[CustomPricing] 💰 {model} | "
-                    f"Tokens: {prompt_tokens}in + {completion_tokens}out = {prompt_tokens + completion_tokens} | "
-                    f"Cost: ${total_cost:.6f} (${input_cost:.6f} + ${output_cost:.6f}) | "
-                    f"Multiplier: {self.price_multiplier}x"
-                )
-
-            # Store custom cost in metadata for logging/tracking
-            litellm_params = kwargs.get("litellm_params", {})
-            metadata = litellm_params.get("metadata", {})
-            metadata["custom_cost"] = total_cost
-            metadata["custom_input_cost"] = input_cost
-            metadata["custom_output_cost"] = output_cost
-            metadata["price_multiplier"] = self.price_multiplier
+            self.cost_aggregator.record(
+                model,
+                user,
+                metadata.get("tags"),
+                usage.get("prompt_tokens", 0),
+                usage.get("completion_tokens", 0),
+            )
 
         except Exception as e:
-            verbose_proxy_logger.error(f"[CustomPricing] ❌ Error calculating cost: {str(e)}")
+            verbose_proxy_logger.error(f"[CustomPricing] ❌ Error recording usage: {str(e)}")
             import traceback
             verbose_proxy_logger.debug(f"[CustomPricing] Traceback: {traceback.format_exc()}")
 
@@ -1,4 +1,9 @@
 #!/bin/bash
-docker compose -f docker-compose.yml -f docker-compose.searxng.yml -f docker-compose.litellm.yml -p openwebui stop
-# docker compose -f docker-compose.yml -f docker-compose.searxng.yml -f docker-compose.litellm.yml -p openwebui pull
-docker compose -f docker-compose.yml -f docker-compose.searxng.yml -f docker-compose.litellm.yml -p openwebui up -d
+# Join the metrics network only when container-monitoring is running
+METRICS=""
+if docker network inspect metrics >/dev/null 2>&1; then
+    METRICS="-f docker-compose.metrics.yml"
+fi
+docker compose -f docker-compose.yml -f docker-compose.searxng.yml -f docker-compose.litellm.yml $METRICS -p openwebui stop
+# docker compose -f docker-compose.yml -f docker-compose.searxng.yml -f docker-compose.litellm.yml $METRICS -p openwebui pull
+docker compose -f docker-compose.yml -f docker-compose.searxng.yml -f docker-compose.litellm.yml $METRICS -p openwebui up -d
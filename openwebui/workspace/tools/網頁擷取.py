@@ -1,6 +1,7 @@
 """
 title: 網頁擷取
 description: 一款使用 Jina Reader 改進提取文本內容準確率的網頁擷取工具
+requirements: beautifulsoup4
 author: changchiyou
 author_url: https://github.com/changchiyou
 github: https://github.com/changchiyou
@@ -8,18 +9,108 @@ original_author: ekatiyar
 original_author_url: https://github.com/ekatiyar/
 original_github: https://github.com/ekatiyar/open-webui-tools
 funding_url: https://github.com/open-webui
-version: 0.0.4
+version: 0.0.10
 license: MIT
 """
 
-import requests
-from typing import Callable, Any
+import aiohttp
+import asyncio
+import codecs
+import ipaddress
+import logging
+import os
+import random
+import socket
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Callable, Any, Literal, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
 import re
+from aiohttp.abc import AbstractResolver
 from pydantic import BaseModel, Field
 
+try:
+    from bs4 import BeautifulSoup, NavigableString
+except ImportError:  # only the local backend needs it
+    BeautifulSoup = None
+
 import unittest
 
 
+logger = logging.getLogger(__name__)
+
+# Errors reported to the LLM instead of raised
+SCRAPE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ImportError)
+
+# Status codes worth another attempt; 429 additionally honours Retry-After
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Longest wait between attempts, whatever Retry-After asks for
+MAX_RETRY_DELAY = 30.0
+# The local backend follows redirects itself, checking every hop
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+# Responses the local backend extracts; anything else (PDFs, images, JSON APIs) is refused
+HTML_TYPES = {"text/html", "application/xhtml+xml"}
+
+# One pooled session per event loop, shared by every scrape
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop = None
+
+# Bounds concurrent requests to r.jina.ai across every web_scrape_many call
+_semaphore: Optional[asyncio.Semaphore] = None
+_semaphore_key = None
+
+# Open WebUI keeps its data in DATA_DIR; scraped pages are shared by every user
+DEFAULT_CACHE_PATH = os.path.join(os.getenv("DATA_DIR", tempfile.gettempdir()), "cache", "web_scrape.sqlite3")
+DEFAULT_PORTS = {"http": 80, "https": 443}
+_caches = {}
+
+# Bytes read from the response per step of the cleaning pipeline
+CHUNK_SIZE = 64 * 1024
+# About 4 UTF-8 bytes per token: 4 ASCII characters, a little over one CJK character
+BYTES_PER_TOKEN = 4
+
+TITLE_PATTERN = re.compile(r"Title: (.*)\n")
+# Link and image targets: [text](https://...) -> [text]
+URL_PATTERN = re.compile(r"\((http[^)]+)\)")
+# Runs of spaces and tabs inside a line; indentation is left alone
+SPACE_PATTERN = re.compile(r"(?<=\S)[ \t]{2,}")
+
+# The local backend fetches pages itself, so it has to look like a browser
+LOCAL_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+}
+# HTML read by the local backend; the rest of larger pages is skipped
+MAX_HTML_BYTES = 8 * 1024 * 1024
+# Never part of the main content
+DROP_TAGS = [
+    "script", "style", "noscript", "template", "svg", "canvas", "iframe", "object", "embed",
+    "form", "button", "input", "select", "textarea", "nav", "footer", "aside", "dialog",
+]
+# class / id hints of boilerplate and of content, after Mozilla's Readability
+NEGATIVE_PATTERN = re.compile(
+    r"comment|sidebar|footer|masthead|\bnav|menu|share|social|sponsor|advert|\bads?\b|banner|cookie|consent|"
+    r"popup|modal|related|promo|breadcrumb|subscribe|newsletter|widget|pager|pagination",
+    re.I,
+)
+POSITIVE_PATTERN = re.compile(r"article|body|content|entry|main|post|story|text|blog", re.I)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+HEADINGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "header", "figure", "figcaption", "dl", "dt", "dd",
+    "address", "details", "summary", "center",
+}
+# Placeholders kept away from whitespace normalization until the markdown is assembled
+_INDENT = "\x01"
+_CODE = "\x02"
+
+
 def extract_title(text):
     """
     Extracts the title from a string containing structured text.
@@ -27,7 +118,7 @@ def extract_title(text):
     :param text: The input string containing the title.
     :return: The extracted title string, or None if the title is not found.
     """
-    match = re.search(r"Title: (.*)\n", text)
+    match = TITLE_PATTERN.search(text)
     return match.group(1).strip() if match else None
 
 
@@ -38,7 +129,660 @@ def clean_urls(text) -> str:
     :param text: The input string containing the URLs.
     :return: The cleaned string with URLs removed.
     """
-    return re.sub(r"\((http[^)]+)\)", "", text)
+    return URL_PATTERN.sub("", text)
+
+
+class ContentCleaner:
+    """
+    Cleans a page line by line while it is downloaded, so the raw body is never held in memory as a whole.
+    Cleaning strips link and image URLs, collapses runs of blank lines and spaces and drops trailing whitespace.
+    With a token budget the output is cut at the last line that fits, and feed() tells the caller to stop reading.
+    """
+
+    def __init__(self, clean: bool = True, max_tokens: int = 0):
+        self.clean = clean
+        self.max_bytes = max_tokens * BYTES_PER_TOKEN
+        self.max_tokens = max_tokens
+        self.size = 0
+        self.lines = []
+        self.pending = ""
+        self.blank = False
+        self.truncated = False
+
+    def feed(self, text: str) -> bool:
+        """
+        Cleans the complete lines of a decoded chunk; a trailing partial line waits for the next chunk.
+
+        :param text: The next decoded chunk of the page.
+        :return: False once the token budget is met and the rest of the page can be skipped.
+        """
+        if self.truncated:
+            return False
+        lines = (self.pending + text).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            if not self.add(line):
+                return False
+        return True
+
+    def add(self, line: str) -> bool:
+        if self.clean:
+            line = SPACE_PATTERN.sub(" ", URL_PATTERN.sub("", line)).rstrip()
+            if not line:
+                if self.blank:
+                    return True
+                self.blank = True
+            else:
+                self.blank = False
+
+        size = len(line.encode("utf-8")) + 1
+        if self.max_bytes and self.size + size > self.max_bytes:
+            self.truncated = True
+            return False
+        self.size += size
+        self.lines.append(line)
+        return True
+
+    def close(self) -> str:
+        """
+        :return: The cleaned page, with a note at the end if it was cut at the token budget.
+        """
+        if not self.truncated:
+            self.add(self.pending)
+        self.pending = ""
+        content = "\n".join(self.lines)
+        if self.truncated:
+            content = content.rstrip() + f"\n\n[Content truncated at about {self.max_tokens} tokens]"
+        return content
+
+
+def _class_weight(tag) -> int:
+    hints = " ".join(tag.get("class") or ()) + " " + (tag.get("id") or "")
+    weight = 0
+    if NEGATIVE_PATTERN.search(hints):
+        weight -= 25
+    if POSITIVE_PATTERN.search(hints):
+        weight += 25
+    return weight
+
+
+def _link_density(tag) -> float:
+    length = len(tag.get_text(strip=True))
+    if not length:
+        return 1.0
+    return sum(len(link.get_text(strip=True)) for link in tag.find_all("a")) / length
+
+
+def find_main_content(soup):
+    """
+    Finds the element holding a page's main content, scoring paragraphs like Mozilla's Readability:
+    every paragraph credits its parent and, halved, its grandparent, by length and number of commas.
+
+    :param soup: The parsed page, with boilerplate tags already removed.
+    :return: The best scoring element, or the body if no paragraph is long enough.
+    """
+    scores = {}
+    for paragraph in soup.find_all(["p", "pre", "td", "blockquote"]):
+        text = paragraph.get_text(" ", strip=True)
+        if len(text) < 25:
+            continue
+        score = 1 + text.count(",") + text.count("，") + text.count("、") + min(len(text) // 100, 3)
+        for level, ancestor in enumerate(list(paragraph.parents)[:3]):
+            if ancestor.name in (None, "[document]", "html"):
+                break
+            if id(ancestor) not in scores:
+                base = {"div": 5, "article": 10, "main": 10, "pre": 3, "td": 3, "blockquote": 3}.get(ancestor.name, 0)
+                scores[id(ancestor)] = [ancestor, base + _class_weight(ancestor)]
+            scores[id(ancestor)][1] += score / (1 if level == 0 else 2 if level == 1 else level * 3)
+
+    if not scores:
+        return soup.body or soup
+    best, _ = max(scores.values(), key=lambda item: item[1] * (1 - _link_density(item[0])))
+    return best
+
+
+class MarkdownWriter:
+    """
+    Converts an HTML element to markdown. Whitespace is collapsed like a browser would;
+    code blocks and list indentation are kept as placeholders until the end.
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.code_blocks = []
+
+    def convert(self, tag) -> str:
+        text = self.block(self.render(tag))
+        text = re.sub(f"{_CODE}(\\d+){_CODE}", lambda match: self.code_blocks[int(match.group(1))], text)
+        return text.replace(_INDENT, "  ")
+
+    def block(self, text: str) -> str:
+        text = re.sub(r"[ \t]*\n[ \t]*", "\n", text)
+        return BLANK_LINES_PATTERN.sub("\n\n", text).strip(" \n")
+
+    def link(self, url: Optional[str]) -> Optional[str]:
+        if not url or url.startswith(("#", "javascript:", "data:", "mailto:")):
+            return None
+        return urljoin(self.base_url, url.strip())
+
+    def children(self, tag) -> str:
+        return "".join(self.render(child) for child in tag.children)
+
+    def render(self, node) -> str:
+        if isinstance(node, NavigableString):
+            # Comments, doctypes and CDATA are NavigableString subclasses
+            return WHITESPACE_PATTERN.sub(" ", node) if type(node) is NavigableString else ""
+
+        name = node.name
+        if name in HEADINGS:
+            text = self.block(self.children(node)).replace("\n", " ")
+            return f"\n\n{'#' * int(name[1])} {text}\n\n" if text else ""
+        if name in BLOCK_TAGS:
+            text = self.block(self.children(node))
+            return f"\n\n{text}\n\n" if text else ""
+        if name == "br":
+            return "\n"
+        if name == "hr":
+            return "\n\n---\n\n"
+        if name == "pre":
+            self.code_blocks.append(f"```\n{node.get_text().strip(chr(10))}\n```")
+            return f"\n\n{_CODE}{len(self.code_blocks) - 1}{_CODE}\n\n"
+        if name == "code":
+            text = node.get_text()
+            return f"`{text}`" if text.strip() else ""
+        if name in ("strong", "b"):
+            text = self.children(node).strip()
+            return f"**{text}**" if text else ""
+        if name in ("em", "i"):
+            text = self.children(node).strip()
+            return f"_{text}_" if text else ""
+        if name == "a":
+            text = self.children(node).strip()
+            href = self.link(node.get("href"))
+            return f"[{text}]({href})" if text and href else text
+        if name == "img":
+            src = self.link(node.get("src") or node.get("data-src"))
+            alt = WHITESPACE_PATTERN.sub(" ", node.get("alt") or "").strip()
+            return f"![{alt}]({src})" if src else ""
+        if name in ("ul", "ol"):
+            items = []
+            for index, item in enumerate(node.find_all("li", recursive=False), 1):
+                text = self.block(self.children(item)).replace("\n\n", "\n")
+                if text:
+                    marker = f"{index}." if name == "ol" else "-"
+                    items.append(f"{marker} " + text.replace("\n", "\n" + _INDENT))
+            return "\n\n" + "\n".join(items) + "\n\n" if items else ""
+        if name == "blockquote":
+            text = self.block(self.children(node))
+            return "\n\n> " + text.replace("\n", "\n> ") + "\n\n" if text else ""
+        if name == "table":
+            rows = []
+            for row in node.find_all("tr"):
+                cells = [self.block(self.children(cell)).replace("\n", " ") for cell in row.find_all(["th", "td"])]
+                if cells:
+                    rows.append("| " + " | ".join(cells) + " |")
+                    if len(rows) == 1:
+                        rows.append("|" + " --- |" * len(cells))
+            return "\n\n" + "\n".join(rows) + "\n\n" if rows else ""
+        return self.children(node)
+
+
+def html_to_markdown(html, url: str, charset: Optional[str] = None) -> str:
+    """
+    Extracts the main content of a page as markdown, shaped like r.jina.ai's output.
+
+    :param html: The page's HTML, as text or as the raw bytes (decoded from the page's own charset declaration).
+    :param url: The page's URL, used to resolve relative links.
+    :param charset: The charset of the Content-Type header, tried first when decoding raw bytes.
+    :return: The title, source URL and markdown content of the page.
+    """
+    if BeautifulSoup is None:
+        raise ImportError("The local backend needs beautifulsoup4")
+    soup = BeautifulSoup(html, "html.parser", from_encoding=charset)
+
+    title = soup.find("meta", property="og:title")
+    title = title.get("content") if title else None
+    if not title and soup.title:
+        title = soup.title.get_text()
+    if not title and soup.h1:
+        title = soup.h1.get_text()
+    base = soup.find("base", href=True)
+    base_url = urljoin(url, base["href"]) if base else url
+
+    for tag in soup(DROP_TAGS):
+        tag.decompose()
+    for tag in soup.find_all(["div", "section", "ul", "header", "span", "p", "table"]):
+        # Boilerplate hints that also look like content (e.g. "main-nav-content") are kept
+        if tag.decomposed:
+            continue
+        hints = " ".join(tag.get("class") or ()) + " " + (tag.get("id") or "")
+        if NEGATIVE_PATTERN.search(hints) and not POSITIVE_PATTERN.search(hints):
+            tag.decompose()
+
+    markdown = MarkdownWriter(base_url).convert(find_main_content(soup))
+    title = WHITESPACE_PATTERN.sub(" ", title or "").strip()
+    return f"Title: {title}\n\nURL Source: {url}\n\nMarkdown Content:\n{markdown}\n"
+
+
+class HtmlExtractor:
+    """
+    Collects a page for the local backend while it is downloaded, then extracts its main content with
+    html_to_markdown() and passes it through a ContentCleaner, so both backends clean and cap pages alike.
+    """
+
+    def __init__(self, url: str, clean: bool = True, max_tokens: int = 0, charset: Optional[str] = None):
+        self.url = url
+        self.charset = charset
+        self.cleaner = ContentCleaner(clean, max_tokens)
+        self.chunks = []
+        self.size = 0
+
+    def feed(self, chunk: bytes) -> bool:
+        # Raw bytes, so BeautifulSoup can honour a <meta charset> the headers did not mention
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        return self.size < MAX_HTML_BYTES
+
+    def close(self) -> str:
+        html = b"".join(self.chunks)
+        self.chunks = []
+        if html.strip():
+            self.cleaner.feed(html_to_markdown(html, self.url, self.charset))
+        return self.cleaner.close()
+
+
+def _is_public_address(host: str) -> bool:
+    address = ipaddress.ip_address(host.split("%", 1)[0])
+    return address.is_global and not address.is_multicast
+
+
+class PublicResolver(AbstractResolver):
+    """
+    aiohttp's default resolver, minus every address that is not public (loopback, private networks,
+    link-local cloud metadata at 169.254.169.254, other containers), so scraped URLs cannot reach internal services.
+    Names are checked when the connection is made, so a later DNS answer cannot slip past the check.
+    Refused hosts raise InvalidURL, which aiohttp passes through and _fetch does not retry.
+    """
+
+    def __init__(self):
+        self.resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET):
+        hosts = await self.resolver.resolve(host, port, family)
+        public = [result for result in hosts if _is_public_address(result["host"])]
+        if not public:
+            raise aiohttp.InvalidURL(host, "does not resolve to a public address")
+        return public
+
+    async def close(self):
+        await self.resolver.close()
+
+
+def _check_public_url(url: str):
+    """
+    Refuses URLs the local backend must not fetch. Host names are left to PublicResolver, IP literals never reach it.
+
+    :param url: The URL about to be fetched.
+    :raises aiohttp.InvalidURL: If the URL is not http(s) or points to a non-public IP address.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in DEFAULT_PORTS or not parts.hostname:
+        raise aiohttp.InvalidURL(url, "only http and https URLs can be scraped")
+    try:
+        public = _is_public_address(parts.hostname)
+    except ValueError:
+        return
+    if not public:
+        raise aiohttp.InvalidURL(url, "not a public address")
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """
+    Returns the shared keep-alive session, creating it on first use (or when the event loop changed).
+
+    :return: The aiohttp ClientSession to scrape with.
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=64, limit_per_host=16, ttl_dns_cache=300, resolver=PublicResolver()
+            )
+        )
+        _session_loop = loop
+    return _session
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalizes a URL so that trivially different spellings share a cache entry.
+
+    :param url: The URL to normalize.
+    :return: The URL with a lowercase scheme and host, no default port, no fragment and sorted query parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if ":" in netloc:
+        # IPv6 literal, bracketed again so the port stays unambiguous
+        netloc = f"[{netloc}]"
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+    if parts.username:
+        netloc = f"{parts.username}{':' + parts.password if parts.password else ''}@{netloc}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+class CacheEntry(NamedTuple):
+    content: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+
+class ScrapeCache:
+    """
+    SQLite cache of scraped pages, shared by every user and evicted least recently used first.
+    The methods block, so call them through asyncio.to_thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self.connect()) as db, db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, etag TEXT, last_modified TEXT, "
+                "fetched_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)")
+
+    def connect(self) -> sqlite3.Connection:
+        # One short-lived connection per call, as the calls run on arbitrary worker threads
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """
+        Looks up a page and marks it as recently used.
+
+        :param key: The cache key.
+        :return: The CacheEntry, or None if the page is not cached.
+        """
+        with closing(self.connect()) as db, db:
+            row = db.execute(
+                "SELECT content, etag, last_modified, fetched_at FROM pages WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE pages SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return CacheEntry(*row)
+
+    def touch(self, key: str):
+        """
+        Marks a page as fresh again after the server confirmed it did not change.
+
+        :param key: The cache key.
+        """
+        now = time.time()
+        with closing(self.connect()) as db, db:
+            db.execute("UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+
+    def put(self, key: str, content: str, etag: Optional[str], last_modified: Optional[str], max_bytes: int):
+        """
+        Stores a page, then evicts the least recently used pages until the cache fits max_bytes.
+
+        :param key: The cache key.
+        :param content: The page content.
+        :param etag: The ETag response header, used to revalidate the page later.
+        :param last_modified: The Last-Modified response header, used to revalidate the page later.
+        :param max_bytes: The size limit of all cached content.
+        """
+        size = len(content.encode("utf-8"))
+        if size > max_bytes:
+            return
+        now = time.time()
+        with closing(self.connect()) as db, db:
+            db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, content, etag, last_modified, now, now, size),
+            )
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            if total <= max_bytes:
+                return
+            evicted = []
+            for old_key, old_size in db.execute("SELECT key, size FROM pages ORDER BY accessed_at"):
+                if total <= max_bytes:
+                    break
+                evicted.append((old_key,))
+                total -= old_size
+            db.executemany("DELETE FROM pages WHERE key = ?", evicted)
+
+
+def _get_cache(path: str) -> ScrapeCache:
+    cache = _caches.get(path)
+    if cache is None:
+        cache = _caches[path] = ScrapeCache(path)
+    return cache
+
+
+async def _cache_call(method: Callable, *args):
+    """
+    Runs a blocking cache call in a worker thread. The cache is best effort: a failure is logged and treated as a miss.
+
+    :param method: The function to call, e.g. ScrapeCache.get or _get_cache.
+    :param args: The arguments of the call.
+    :return: The result of the call, or None if the cache failed.
+    """
+    try:
+        return await asyncio.to_thread(method, *args)
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Scraping without the page cache: {e}")
+        return None
+
+
+def _get_semaphore(limit: int) -> asyncio.Semaphore:
+    """
+    Returns the shared semaphore bounding concurrent scrapes, recreated when the limit or event loop changed.
+
+    :param limit: The number of scrapes allowed to run at once.
+    :return: The asyncio Semaphore to acquire around each scrape.
+    """
+    global _semaphore, _semaphore_key
+    key = (asyncio.get_running_loop(), limit)
+    if _semaphore is None or _semaphore_key != key:
+        _semaphore = asyncio.Semaphore(max(limit, 1))
+        _semaphore_key = key
+    return _semaphore
+
+
+async def _close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _retry_delay(attempt: int, backoff: float, retry_after: Optional[str] = None) -> float:
+    """
+    Computes how long to wait before the next attempt.
+
+    :param attempt: The number of the attempt that just failed, starting at 0.
+    :param backoff: The base delay in seconds.
+    :param retry_after: The Retry-After header of a 429 response, in seconds or as an HTTP date.
+    :return: The delay in seconds: Retry-After when given, otherwise exponential backoff with full jitter.
+    """
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0.0), MAX_RETRY_DELAY)
+    return random.uniform(0, min(backoff * 2**attempt, MAX_RETRY_DELAY))
+
+
+async def _open(url: str, headers: dict, timeout: aiohttp.ClientTimeout, direct: bool) -> aiohttp.ClientResponse:
+    """
+    Sends the GET with the shared session. Direct fetches follow redirects one hop at a time, checking each hop.
+
+    :param url: The URL to fetch.
+    :param headers: The request headers.
+    :param timeout: The connect and read timeouts.
+    :param direct: Whether the URL is fetched directly rather than through r.jina.ai.
+    :return: The response, to be used as an async context manager.
+    """
+    if not direct:
+        return await _get_session().get(url, headers=headers, timeout=timeout)
+    for _ in range(MAX_REDIRECTS + 1):
+        _check_public_url(url)
+        response = await _get_session().get(url, headers=headers, timeout=timeout, allow_redirects=False)
+        location = response.headers.get("Location")
+        if response.status not in REDIRECT_STATUSES or not location:
+            return response
+        response.release()
+        url = urljoin(str(response.url), location)
+    raise aiohttp.InvalidURL(url, f"more than {MAX_REDIRECTS} redirects")
+
+
+async def _fetch(
+    url: str, headers: dict, timeout: aiohttp.ClientTimeout, retries: int, backoff: float, emitter,
+    new_cleaner: Callable[[Optional[str]], Any], direct: bool = False,
+):
+    """
+    GETs a URL with the shared session, retrying connection errors, timeouts and retryable statuses.
+    The body is streamed through a ContentCleaner, which may stop the download early.
+
+    :param url: The URL to fetch.
+    :param headers: The request headers.
+    :param timeout: The connect and read timeouts.
+    :param retries: How many times a failed attempt is retried.
+    :param backoff: The base delay between attempts in seconds.
+    :param emitter: The EventEmitter reporting retries.
+    :param new_cleaner: Creates the ContentCleaner (or HtmlExtractor) of each attempt from the response charset.
+    :param direct: Fetch the page itself (local backend): every redirect hop must be public, only HTML is read,
+        and the cleaner is fed raw bytes so the page's own charset declaration is honoured.
+    :return: The response status, cleaned body and headers.
+    """
+    for attempt in range(retries + 1):
+        retry_after = None
+        try:
+            async with await _open(url, headers, timeout, direct) as response:
+                if response.status not in RETRY_STATUSES or attempt == retries:
+                    response.raise_for_status()
+                    if direct and response.status != 304 and response.content_type not in HTML_TYPES:
+                        raise aiohttp.ContentTypeError(
+                            response.request_info, response.history, status=response.status,
+                            message=f"Not an HTML page ({response.content_type})", headers=response.headers,
+                        )
+                    cleaner = new_cleaner(response.charset)
+                    decoder = None
+                    if not direct:
+                        decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(errors="replace")
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        if not cleaner.feed(chunk if decoder is None else decoder.decode(chunk)):
+                            # Leaving the block closes the connection instead of reading the rest
+                            break
+                    else:
+                        if decoder is not None:
+                            cleaner.feed(decoder.decode(b"", final=True))
+                    return response.status, cleaner.close(), response.headers
+                reason = f"HTTP {response.status}"
+                if response.status == 429:
+                    retry_after = response.headers.get("Retry-After")
+                    reason = "Rate limited"
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                raise
+            reason = type(e).__name__
+
+        delay = _retry_delay(attempt, backoff, retry_after)
+        await emitter.progress_update(f"{reason}, retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+        await asyncio.sleep(delay)
+
+
+def _jina_headers(valves, user: dict) -> dict:
+    """
+    Builds the r.jina.ai request headers, preferring the user's API key over the global one.
+
+    :param valves: The tool Valves.
+    :param user: The __user__ dict passed to the tool.
+    :return: The request headers.
+    """
+    headers = {
+        "X-No-Cache": "true" if valves.DISABLE_CACHING else "false",
+        "X-With-Generated-Alt": "true",
+    }
+
+    if "valves" in user and user["valves"].JINA_API_KEY:
+        headers["Authorization"] = f"Bearer {user['valves'].JINA_API_KEY}"
+    elif valves.GLOBAL_JINA_API_KEY:
+        headers["Authorization"] = f"Bearer {valves.GLOBAL_JINA_API_KEY}"
+    return headers
+
+
+async def _scrape(url: str, valves, user: dict, emitter):
+    """
+    Scrapes one web page through r.jina.ai or the local backend and cleans it unless the user turned cleaning off.
+    Fresh pages are served from the local cache; stale ones are revalidated with the stored ETag / Last-Modified.
+
+    :param url: The URL of the web page to scrape.
+    :param valves: The tool Valves.
+    :param user: The __user__ dict passed to the tool.
+    :param emitter: The EventEmitter reporting retries.
+    :return: The scraped content, and whether it came from the cache. Network errors and error responses are raised.
+    """
+    should_clean = "valves" not in user or user["valves"].CLEAN_CONTENT
+    max_tokens = max(valves.MAX_CONTENT_TOKENS, 0)
+    if valves.BACKEND == "local":
+        if BeautifulSoup is None:
+            raise ImportError("The local backend needs beautifulsoup4")
+        fetch_url, headers = url, dict(LOCAL_HEADERS)
+
+        def new_cleaner(charset: Optional[str]) -> HtmlExtractor:
+            return HtmlExtractor(url, should_clean, max_tokens, charset)
+    else:
+        fetch_url, headers = f"https://r.jina.ai/{url}", _jina_headers(valves, user)
+
+        def new_cleaner(charset: Optional[str]) -> ContentCleaner:
+            return ContentCleaner(should_clean, max_tokens)
+
+    try:
+        key = f"{valves.BACKEND}:{'clean' if should_clean else 'raw'}:{max_tokens}:{normalize_url(url)}"
+    except ValueError as e:
+        raise aiohttp.InvalidURL(url, str(e)) from e
+    cache = await _cache_call(_get_cache, valves.CACHE_PATH) if valves.CACHE_TTL > 0 else None
+    entry = None
+    if cache is not None and not valves.DISABLE_CACHING:
+        entry = await _cache_call(cache.get, key)
+        if entry is not None:
+            if time.time() - entry.fetched_at < valves.CACHE_TTL:
+                return entry.content, True
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+
+    timeout = aiohttp.ClientTimeout(sock_connect=valves.CONNECT_TIMEOUT, sock_read=valves.READ_TIMEOUT)
+    status, content, response_headers = await _fetch(
+        fetch_url, headers, timeout, valves.MAX_RETRIES, valves.RETRY_BACKOFF, emitter, new_cleaner,
+        direct=valves.BACKEND == "local",
+    )
+    if status == 304 and entry is not None:
+        await _cache_call(cache.touch, key)
+        return entry.content, True
+
+    if cache is not None:
+        await _cache_call(
+            cache.put, key, content, response_headers.get("ETag"), response_headers.get("Last-Modified"),
+            valves.CACHE_MAX_BYTES,
+        )
+    return content, False
 
 
 class EventEmitter:
@@ -70,13 +814,49 @@ class EventEmitter:
 
 class Tools:
     class Valves(BaseModel):
+        BACKEND: Literal["jina", "local"] = Field(
+            default="jina",
+            description="jina: scrape through r.jina.ai. local: fetch public HTML pages directly and extract the main content with BeautifulSoup (no external service, but no JavaScript rendering)",
+        )
         DISABLE_CACHING: bool = Field(
-            default=False, description="Bypass Jina Cache when scraping"
+            default=False, description="Bypass Jina Cache and the local page cache when scraping"
         )
         GLOBAL_JINA_API_KEY: str = Field(
             default="",
             description="(Optional) Jina API key. Allows a higher rate limit when scraping. Used when a User-specific API key is not available.",
         )
+        CONNECT_TIMEOUT: float = Field(
+            default=10.0, description="Seconds to wait for a connection to r.jina.ai (or the page, with the local backend)"
+        )
+        READ_TIMEOUT: float = Field(
+            default=60.0, description="Seconds to wait for data while a page is scraped"
+        )
+        MAX_RETRIES: int = Field(
+            default=3,
+            description="Retries after connection errors, timeouts, rate limiting (HTTP 429) and 5xx responses",
+        )
+        RETRY_BACKOFF: float = Field(
+            default=1.0, description="Base delay in seconds between retries, doubled per attempt with random jitter"
+        )
+        MAX_CONCURRENT_SCRAPES: int = Field(
+            default=5,
+            description="Pages web_scrape_many fetches at once. Keep it within the Jina rate limit (20 RPM without an API key)",
+        )
+        MAX_CONTENT_TOKENS: int = Field(
+            default=0,
+            description="Cut scraped pages at about this many tokens and stop downloading the rest. 0 keeps whole pages",
+        )
+        CACHE_TTL: int = Field(
+            default=3600,
+            description="Seconds a scraped page is served from the local cache before it is revalidated. 0 disables the cache",
+        )
+        CACHE_MAX_BYTES: int = Field(
+            default=256 * 1024 * 1024,
+            description="Size limit of the local page cache; the least recently used pages are evicted first",
+        )
+        CACHE_PATH: str = Field(
+            default=DEFAULT_CACHE_PATH, description="SQLite file of the local page cache"
+        )
 
     class UserValves(BaseModel):
         CLEAN_CONTENT: bool = Field(
@@ -99,7 +879,7 @@ class Tools:
         __user__: dict = {},
     ) -> str:
         """
-        Scrape and process a web page using r.jina.ai
+        Scrape and process a web page
 
         :param url: The URL of the web page to scrape.
         :return: The scraped and processed webpage content, or an error message.
@@ -107,45 +887,128 @@ class Tools:
         emitter = EventEmitter(__event_emitter__)
 
         await emitter.progress_update(f"Scraping {url}")
-        jina_url = f"https://r.jina.ai/{url}"
-
-        headers = {
-            "X-No-Cache": "true" if self.valves.DISABLE_CACHING else "false",
-            "X-With-Generated-Alt": "true",
-        }
-
-        if "valves" in __user__ and __user__["valves"].JINA_API_KEY:
-            headers["Authorization"] = f"Bearer {__user__['valves'].JINA_API_KEY}"
-        elif self.valves.GLOBAL_JINA_API_KEY:
-            headers["Authorization"] = f"Bearer {self.valves.GLOBAL_JINA_API_KEY}"
 
         try:
-            response = requests.get(jina_url, headers=headers)
-            response.raise_for_status()
-
-            should_clean = "valves" not in __user__ or __user__["valves"].CLEAN_CONTENT
-            if should_clean:
-                await emitter.progress_update("Received content, cleaning up ...")
-            content = clean_urls(response.text) if should_clean else response.text
+            content, cached = await _scrape(url, self.valves, __user__, emitter)
 
             title = extract_title(content)
             await emitter.success_update(
-                f"Successfully Scraped {title if title else url}"
+                f"Successfully Scraped {title if title else url}{' (cached)' if cached else ''}"
             )
             return content
 
-        except requests.RequestException as e:
-            error_message = f"Error scraping web page: {str(e)}"
+        except SCRAPE_ERRORS as e:
+            error_message = f"Error scraping web page: {str(e) or type(e).__name__}"
             await emitter.error_update(error_message)
             return error_message
 
+    async def web_scrape_many(
+        self,
+        urls: list[str],
+        __event_emitter__: Callable[[dict], Any] = None,
+        __user__: dict = {},
+    ) -> str:
+        """
+        Scrape and process several web pages at once
+
+        :param urls: The URLs of the web pages to scrape.
+        :return: The content of every page in the given order, each under its URL, or an error message for pages that failed.
+        """
+        emitter = EventEmitter(__event_emitter__)
+        if not urls:
+            return "No URLs given"
+
+        await emitter.progress_update(f"Scraping {len(urls)} pages")
+        semaphore = _get_semaphore(self.valves.MAX_CONCURRENT_SCRAPES)
+        done = 0
+        failed = 0
+
+        async def scrape(url):
+            nonlocal done, failed
+            async with semaphore:
+                try:
+                    content, cached = await _scrape(url, self.valves, __user__, emitter)
+                except SCRAPE_ERRORS as e:
+                    content = f"Error scraping web page: {str(e) or type(e).__name__}"
+                    failed += 1
+                    title, cached = None, False
+                else:
+                    title = extract_title(content)
+            done += 1
+            await emitter.progress_update(
+                f"Scraped {done}/{len(urls)}: {title if title else url}{' (cached)' if cached else ''}"
+            )
+            return content
+
+        contents = await asyncio.gather(*(scrape(url) for url in urls))
+
+        summary = f"Scraped {len(urls) - failed}/{len(urls)} pages"
+        if failed == len(urls):
+            await emitter.error_update(f"{summary}, all failed")
+        else:
+            await emitter.success_update(f"{summary}, {failed} failed" if failed else summary)
+        return "\n\n".join(f"## {url}\n\n{content}" for url, content in zip(urls, contents, strict=True))
+
 
 class WebScrapeTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await _close_session()
+
     async def test_web_scrape(self):
         url = "https://toscrape.com/"
         content = await Tools().web_scrape(url)
         self.assertEqual("Scraping Sandbox", extract_title(content))
-        self.assertEqual(len(content), 770)
+        # Whitespace is collapsed, so the page can only be shorter than Jina's own output
+        self.assertLessEqual(len(content), 770)
+
+    async def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ScrapeCache(os.path.join(directory, "cache.sqlite3"))
+            cache.put("a", "a" * 60, '"v1"', None, 100)
+            cache.put("b", "b" * 30, None, None, 100)
+            self.assertEqual('"v1"', cache.get("a").etag)
+            cache.put("c", "c" * 30, None, None, 100)
+            # b was used least recently
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual("c" * 30, cache.get("c").content)
+        self.assertEqual(
+            "https://example.com/?a=1&b=2", normalize_url("HTTPS://Example.com:443?b=2&a=1#top")
+        )
+        self.assertEqual("http://[::1]:8080/", normalize_url("http://[::1]:8080"))
+
+    async def test_cache_failure(self):
+        # An unusable cache path or an invalid URL fails that page only
+        with tempfile.NamedTemporaryFile() as file:
+            tools = Tools()
+            tools.valves.CACHE_PATH = os.path.join(file.name, "cache.sqlite3")
+            self.assertIsNone(await _cache_call(_get_cache, tools.valves.CACHE_PATH))
+            content = await tools.web_scrape_many(["http://example.com:99999/"])
+        self.assertIn("Error scraping web page", content)
+
+    def test_content_cleaner(self):
+        page = "Title: Page\n\n\n\n![img](https://a.com/i.png)  [link](http://b.com)   \n    code\nlast"
+        cleaner = ContentCleaner()
+        for index in range(0, len(page), 7):
+            cleaner.feed(page[index:index + 7])
+        self.assertEqual("Title: Page\n\n![img] [link]\n    code\nlast", cleaner.close())
+
+        cleaner = ContentCleaner(max_tokens=4)
+        self.assertFalse(cleaner.feed(page))
+        self.assertEqual("Title: Page\n\n[Content truncated at about 4 tokens]", cleaner.close())
+
+    @unittest.skipIf(BeautifulSoup is None, "beautifulsoup4 is not installed")
+    def test_html_to_markdown(self):
+        html = (
+            "<html><head><title>Page</title><script>var x = 1;</script></head><body>"
+            "<nav><a href='/'>Home</a></nav><div class='sidebar'><p>Other stories, more stories, even more</p></div>"
+            "<article><h1>Heading</h1><p>A long enough paragraph, with commas, about <a href='/b'>something</a>.</p>"
+            "<ul><li>one</li><li>two</li></ul></article><footer>Copyright</footer></body></html>"
+        )
+        self.assertEqual(
+            "Title: Page\n\nURL Source: https://a.com/x\n\nMarkdown Content:\n# Heading\n\n"
+            "A long enough paragraph, with commas, about [something](https://a.com/b).\n\n- one\n- two\n",
+            html_to_markdown(html, "https://a.com/x"),
+        )
 
 
 if __name__ == "__main__":
@@ -8,7 +8,7 @@ original_author: ekatiyar
 original_author_url: https://github.com/christ-offer/
 original_github: https://github.com/christ-offer/open-webui-tools
 funding_url: https://github.com/open-webui
-version: 0.0.10
+version: 0.0.13
 license: MIT
 requirements: finnhub-python
 """
@@ -18,6 +18,10 @@ import finnhub
 import requests
 import aiohttp
 import asyncio
+import ipaddress
+import socket
+from aiohttp.abc import AbstractResolver
+from urllib.parse import urljoin, urlsplit
 from transformers import pipeline, AutoTokenizer, AutoModelForSequenceClassification
 import torch
 from bs4 import BeautifulSoup
@@ -27,6 +31,7 @@ from typing import (
     Dict,
     Any,
     List,
+    Literal,
     Union,
     Generator,
     Iterator,
@@ -93,14 +98,131 @@ def _get_company_news(client: finnhub.Client, ticker: str) -> List[Dict[str, str
     return [{"url": item["url"], "title": item["headline"]} for item in news_items]
 
 
-async def _async_web_scrape(session: aiohttp.ClientSession, url: str) -> str:
+# The local backend fetches news pages itself, so it has to look like a browser
+LOCAL_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+}
+# The local backend follows redirects itself, checking every hop, and only reads HTML
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+HTML_TYPES = {"text/html", "application/xhtml+xml"}
+# News pages are read in chunks and cut off past MAX_HTML_BYTES; the article text comes well before that
+CHUNK_SIZE = 64 * 1024
+MAX_HTML_BYTES = 8 * 1024 * 1024
+# Without a timeout a stalled news site would hold the whole analysis for aiohttp's 5 minute default
+SCRAPE_TIMEOUT = aiohttp.ClientTimeout(sock_connect=10, sock_read=60)
+
+
+def _is_public_address(host: str) -> bool:
+    address = ipaddress.ip_address(host.split("%", 1)[0])
+    return address.is_global and not address.is_multicast
+
+
+class PublicResolver(AbstractResolver):
+    """
+    aiohttp's default resolver, minus every address that is not public (loopback, private networks,
+    link-local cloud metadata, other containers), so news links cannot reach internal services
+    """
+
+    def __init__(self):
+        self.resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET):
+        hosts = await self.resolver.resolve(host, port, family)
+        public = [result for result in hosts if _is_public_address(result["host"])]
+        if not public:
+            raise aiohttp.InvalidURL(host, "does not resolve to a public address")
+        return public
+
+    async def close(self):
+        await self.resolver.close()
+
+
+def _check_public_url(url: str):
+    """Refuse non-http(s) URLs and non-public IP literals, which never reach PublicResolver"""
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise aiohttp.InvalidURL(url, "only http and https URLs can be scraped")
+    try:
+        public = _is_public_address(parts.hostname)
+    except ValueError:
+        return
+    if not public:
+        raise aiohttp.InvalidURL(url, "not a public address")
+
+
+async def _fetch_html(session: aiohttp.ClientSession, url: str) -> Tuple[bytes, Optional[str]]:
     """
-    Scrape and process a web page using r.jina.ai
+    Fetch a news page directly, following redirects one checked hop at a time
+
+    :param session: The aiohttp ClientSession to use for the request.
+    :param url: The URL of the news page.
+    :return: The page's raw HTML, at most MAX_HTML_BYTES of it, and the charset of its Content-Type header.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        _check_public_url(url)
+        async with session.get(url, headers=LOCAL_HEADERS, allow_redirects=False) as response:
+            location = response.headers.get("Location")
+            if response.status in REDIRECT_STATUSES and location:
+                url = urljoin(str(response.url), location)
+                continue
+            response.raise_for_status()
+            if response.content_type not in HTML_TYPES:
+                raise aiohttp.ContentTypeError(
+                    response.request_info, response.history, status=response.status,
+                    message=f"Not an HTML page ({response.content_type})", headers=response.headers,
+                )
+            html = bytearray()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                html += chunk
+                if len(html) >= MAX_HTML_BYTES:
+                    # Leaving the block closes the connection instead of reading the rest
+                    del html[MAX_HTML_BYTES:]
+                    break
+            return bytes(html), response.charset
+    raise aiohttp.InvalidURL(url, f"more than {MAX_REDIRECTS} redirects")
+
+
+def _extract_main_text(html: bytes, charset: Optional[str] = None) -> str:
+    """
+    Extract the article text of a news page: the paragraphs of the element holding the most paragraph text.
+
+    :param html: The page's raw HTML, decoded from its own charset declaration.
+    :param charset: The charset of the Content-Type header, tried first.
+    :return: The article's paragraphs, separated by blank lines.
+    """
+    soup = BeautifulSoup(html, "html.parser", from_encoding=charset)
+    for tag in soup(["script", "style", "noscript", "nav", "header", "footer", "aside", "form"]):
+        tag.decompose()
+
+    paragraphs = {}
+    for paragraph in soup.find_all("p"):
+        text = paragraph.get_text(" ", strip=True)
+        if len(text) >= 25:
+            paragraphs.setdefault(id(paragraph.parent), []).append(text)
+    if not paragraphs:
+        return soup.get_text(" ", strip=True)
+    return "\n\n".join(max(paragraphs.values(), key=lambda texts: sum(map(len, texts))))
+
+
+async def _async_web_scrape(session: aiohttp.ClientSession, url: str, backend: str = "jina") -> str:
+    """
+    Scrape and process a web page using r.jina.ai, or fetch it directly and extract the article text locally
 
     :param session: The aiohttp ClientSession to use for the request.
     :param url: The URL of the web page to scrape.
+    :param backend: "jina" or "local".
     :return: The scraped and processed content without the Links/Buttons section, or an error message.
     """
+    if backend == "local":
+        try:
+            html, charset = await _fetch_html(session, url)
+            return _extract_main_text(html, charset)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return f"Error scraping web page: {str(e) or type(e).__name__}"
+
     jina_url = f"https://r.jina.ai/{url}"
 
     headers = {
@@ -121,8 +243,8 @@ async def _async_web_scrape(session: aiohttp.ClientSession, url: str) -> str:
 
         return content
 
-    except aiohttp.ClientError as e:
-        return f"Error scraping web page: {str(e)}"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return f"Error scraping web page: {str(e) or type(e).__name__}"
 
 
 # Asynchronous sentiment analysis
@@ -148,14 +270,16 @@ async def _async_sentiment_analysis(content: str) -> Dict[str, Union[str, float]
 
 # Asynchronous data gathering
 async def _async_gather_stock_data(
-    client: finnhub.Client, ticker: str
+    client: finnhub.Client, ticker: str, backend: str = "jina"
 ) -> Dict[str, Any]:
     basic_info = _get_basic_info(client, ticker)
     current_price = _get_current_price(client, ticker)
     news_items = _get_company_news(client, ticker)
 
-    async with aiohttp.ClientSession() as session:
-        scrape_tasks = [_async_web_scrape(session, item["url"]) for item in news_items]
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(resolver=PublicResolver()), timeout=SCRAPE_TIMEOUT
+    ) as session:
+        scrape_tasks = [_async_web_scrape(session, item["url"], backend) for item in news_items]
         contents = await asyncio.gather(*scrape_tasks)
 
     sentiment_tasks = [
@@ -282,6 +406,10 @@ class Tools:
             default="",
             description="Global Finnhub API key."
         )
+        SCRAPE_BACKEND: Literal["jina", "local"] = Field(
+            default="jina",
+            description="How news articles are scraped. jina: through r.jina.ai. local: fetch public HTML pages directly and extract the article text with BeautifulSoup."
+        )
     class UserValves(BaseModel):
         USER_FINNHUB_API_KEY: str = Field(
             default="",
@@ -329,7 +457,7 @@ class Tools:
                 "data": {"description": "Retrieving stock data", "done": False},
             }
         )
-        data = await _async_gather_stock_data(self.client, ticker)
+        data = await _async_gather_stock_data(self.client, ticker, self.valves.SCRAPE_BACKEND)
         await __event_emitter__(
             {
                 "type": "status",